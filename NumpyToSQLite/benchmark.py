@@ -0,0 +1,196 @@
+import numpy as np
+import os
+import json
+import time
+import queue
+import shutil
+import multiprocessing
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import create_databasev2 as converter
+from synthetic_arrays import CreateSyntheticArrays
+from instrumentation import PeakRSS, ChildrenPeakRSS
+
+class StageClock:
+    # Times consecutive stages of one benchmark run
+    def __init__(self):
+        self.stages = []
+        self.last   = time.time()
+
+    def stop(self,stage,rows):
+        now = time.time()
+        self.stages.append({'stage': stage,
+                            'seconds': now - self.last,
+                            'rows': int(rows),
+                            'rows_per_sec': rows/max(now - self.last, 1e-9),
+                            'peak_rss_mb': max(PeakRSS(), ChildrenPeakRSS())})
+        self.last = now
+
+def BenchmarkBatch(array_path,key,gcd_path,outdir,n_workers,df_size):
+    # The stages of batch mode, timed one by one with the functions CreateDataBase uses
+    clock      = StageClock()
+    data       = np.load(array_path + '/' + key + '/data.npy')
+    data_index = np.load(array_path + '/' + key + '/index.npy')
+    truth      = np.load(array_path + '/MCInIcePrimary/data.npy')
+    n_pulses   = len(data)
+    n_events   = len(truth)
+    clock.stop('load',n_pulses + n_events)
+
+    geo        = converter.GrabGCD(gcd_path)
+    truth      = converter.ExtractTruth(truth)
+    features   = {'features': converter.ExtractFeatures(data,data_index,geo)}
+    del data
+    clock.stop('geometry',n_pulses + n_events)
+
+    transformer_dict = converter.FitTransformers(features,truth)
+    features['features'] = converter.ApplyTransformers(features['features'],transformer_dict['input'])
+    truth      = converter.ApplyTransformers(truth,transformer_dict['truth'])
+    clock.stop('scaling',n_pulses + n_events)
+
+    db_path, transformer_path = converter.MakeOutputDirectories(outdir,'benchmark')
+    data_tables = {'truth': truth}
+    data_tables.update(features)
+    del truth, features
+    converter.WriteTemporaries(data_tables,db_path + '/benchmark.db',n_workers,df_size)
+    clock.stop('write',n_pulses + n_events)
+
+    converter.MergeTemporaryDataBases(db_path,['truth','features'],delete_temporaries = True)
+    clock.stop('merge',n_pulses + n_events)
+    return clock.stages
+
+def BenchmarkMode(array_path,key,gcd_path,outdir,n_workers,df_size,mode):
+    # End-to-end run of CreateDataBase. Streaming and pipeline mode interleave their stages, so the per-stage numbers
+    # come from the metrics.json the converter writes (stages summed over all chunks), followed by the total.
+    clock      = StageClock()
+    n_pulses   = len(np.load(array_path + '/' + key + '/data.npy', mmap_mode = 'r'))
+    n_events   = len(np.load(array_path + '/MCInIcePrimary/data.npy', mmap_mode = 'r'))
+    metrics_path = outdir + '/metrics.json'
+    os.makedirs(outdir, exist_ok = True)
+    converter.CreateDataBase(array_path,'benchmark',key,gcd_path,outdir,n_workers,mode = mode,df_size = df_size,metrics_path = metrics_path)
+    clock.stop('total',n_pulses + n_events)
+    with open(metrics_path, 'r') as tmp:
+        stages = json.load(tmp)['stages']
+    return [{'stage': stage['stage'],
+             'seconds': stage['seconds'],
+             'rows': stage['rows'],
+             'rows_per_sec': stage['rows_per_sec'],
+             'peak_rss_mb': stage['peak_rss_mb']} for stage in stages] + clock.stages
+
+def RunConfiguration(settings,results):
+    # Runs in its own process, so that the peak RSS belongs to this configuration only
+    array_path, key, gcd_path, outdir, n_workers, df_size, mode = settings
+    if mode == 'batch':
+        stages = BenchmarkBatch(array_path,key,gcd_path,outdir,n_workers,df_size)
+        stages.append({'stage': 'total',
+                       'seconds': sum([stage['seconds'] for stage in stages]),
+                       'rows': stages[0]['rows'],
+                       'rows_per_sec': stages[0]['rows']/max(sum([stage['seconds'] for stage in stages]), 1e-9),
+                       'peak_rss_mb': max(PeakRSS(), ChildrenPeakRSS())})
+    else:
+        stages = BenchmarkMode(array_path,key,gcd_path,outdir,n_workers,df_size,mode)
+    results.put(stages)
+    return
+
+def WaitForConfiguration(process,results,timeout = None):
+    # The stages RunConfiguration puts on results, or None if the process exits without them (it crashed)
+    # or is still running after timeout seconds (it hangs), in which case it is terminated
+    start = time.time()
+    while True:
+        try:
+            return results.get(timeout = 1)
+        except queue.Empty:
+            pass
+        if process.exitcode is not None:
+            # the result may have arrived between the timeout and the exit
+            try:
+                return results.get(timeout = 1)
+            except queue.Empty:
+                print('CONFIGURATION FAILED WITH EXIT CODE %s'%process.exitcode)
+                return None
+        if timeout is not None and time.time() - start > timeout:
+            print('CONFIGURATION STILL RUNNING AFTER %s s, TERMINATING IT'%timeout)
+            process.terminate()
+            return None
+
+def Benchmark(outdir,n_events,n_workers,modes,df_size = 100000,mean_pulses = 20,json_path = None,keep = False,timeout = None):
+    # Converts synthetic arrays of every size in n_events with every worker count in n_workers and every mode,
+    # and reports rows/sec and peak RSS for each stage. Rows are pulses + events.
+    # A configuration that crashes or runs longer than timeout seconds is reported as a single 'failed' stage.
+    report = []
+    for events in n_events:
+        array_path, gcd_path = CreateSyntheticArrays(outdir + '/arrays_%s'%events,events,mean_pulses = mean_pulses)
+        for workers in n_workers:
+            for mode in modes:
+                run_dir = outdir + '/run_%s_%s_%s'%(events,workers,mode)
+                if os.path.isdir(run_dir):
+                    shutil.rmtree(run_dir)
+                results = multiprocessing.Queue()
+                process = multiprocessing.Process(target = RunConfiguration, args = ([array_path,'SplitInIcePulses',gcd_path,run_dir,workers,df_size,mode],results))
+                process.start()
+                start   = time.time()
+                stages  = WaitForConfiguration(process,results,timeout)
+                process.join()
+                if stages is None:
+                    stages = [{'stage': 'failed', 'seconds': time.time() - start, 'rows': 0, 'rows_per_sec': 0.0, 'peak_rss_mb': 0.0, 'exitcode': process.exitcode}]
+                for stage in stages:
+                    stage.update({'n_events': events, 'n_workers': workers, 'mode': mode})
+                    report.append(stage)
+                if not keep and os.path.isdir(run_dir):
+                    shutil.rmtree(run_dir)
+        if not keep:
+            shutil.rmtree(array_path)
+
+    print('%10s %9s %10s %10s %10s %14s %12s'%('n_events','n_workers','mode','stage','seconds','rows/sec','peak RSS MB'))
+    for stage in report:
+        print('%10s %9s %10s %10s %10.2f %14.0f %12.0f'%(stage['n_events'],stage['n_workers'],stage['mode'],stage['stage'],stage['seconds'],stage['rows_per_sec'],stage['peak_rss_mb']))
+    if json_path is not None:
+        with open(json_path, 'w') as tmp:
+            json.dump(report, tmp, indent = 1)
+    return report
+
+def parse_args(description=__doc__):
+    """Parse command line args"""
+    parser = ArgumentParser(
+        description=description,
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--outdir', type=str, required=True,
+        help='Scratch directory for the synthetic arrays and the databases',
+    )
+    parser.add_argument(
+        '--n_events', type=int, nargs='+', default=[100000],
+        help='Dataset sizes to benchmark, in events',
+    )
+    parser.add_argument(
+        '--n_workers', type=int, nargs='+', default=[4],
+        help='Worker counts to benchmark',
+    )
+    parser.add_argument(
+        '--modes', type=str, nargs='+', default=['batch', 'streaming', 'pipeline'],
+        help='Conversion modes to benchmark',
+    )
+    parser.add_argument(
+        '--df_size', type=int, default=100000,
+        help='df_size passed to the converter',
+    )
+    parser.add_argument(
+        '--mean_pulses', type=float, default=20,
+        help='Mean number of pulses per synthetic event',
+    )
+    parser.add_argument(
+        '--json_path', type=str, default=None,
+        help='If given, the report is also written to this file as JSON',
+    )
+    parser.add_argument(
+        '--keep', action='store_true',
+        help='Keep the synthetic arrays and databases',
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=None,
+        help='Seconds after which a configuration that is still running is terminated and reported as failed',
+    )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    Benchmark(**vars(parse_args()))
@@ -0,0 +1,234 @@
+import os
+import glob
+import time
+import sqlite3
+from multiprocessing import Pool
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import create_databasev2 as converter
+from instrumentation import Metrics, WorkerStats
+
+def FindRuns(array_paths):
+    # Expands the glob patterns in array_paths to i3cols directories, i.e. directories with an MCInIcePrimary array.
+    # The order of the runs (and so of their event numbers) is the sorted order of each pattern, pattern after pattern.
+    runs = []
+    for pattern in array_paths:
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            path = os.path.abspath(path)
+            if os.path.isfile(path + '/MCInIcePrimary/data.npy') and path not in runs:
+                runs.append(path)
+    if len(runs) == 0:
+        raise ValueError('No i3cols directories found in %s'%array_paths)
+    return runs
+
+def MergePair(settings):
+    # One node of the merge tree: the right shard is copied into the left one and deleted
+    left, right, tables, pragmas, schema = settings
+    start_time = time.time()
+    converter.MergeShards(left,[right],tables,delete_shards = True,pragmas = pragmas,schema = schema)
+    return left, WorkerStats('merge',start_time,bytes_written = os.path.getsize(left))
+
+def MergeTree(shards,tables,n_workers,pragmas = None,schema = 'plain',metrics = None):
+    # Merges the shards pairwise, all pairs of a level in parallel, until one database is left.
+    # Pairs are neighbours in event order, so every merge appends the later event range to the earlier one.
+    if metrics is None:
+        metrics = Metrics()
+    level = 0
+    p = Pool(processes = n_workers)
+    while len(shards) > 1:
+        level   += 1
+        pairs    = [[shards[j],shards[j + 1],tables,pragmas,schema] for j in range(0,len(shards) - 1,2)]
+        print('MERGE LEVEL %s: %s PAIRS'%(level,len(pairs)))
+        merged   = []
+        for left, stats in p.imap(MergePair, pairs):
+            metrics.add_worker(stats)
+            merged.append(left)
+        if len(shards)%2 == 1:
+            merged.append(shards[-1])
+        shards   = merged
+    p.close()
+    p.join()
+    return shards[0]
+
+def RegisterRuns(db_file,runs,n_events,settings):
+    # Records every run as fully committed in the manifest, so that create_databasev2.py --append can add
+    # more runs to the merged database later, numbering their events after these. Runs without events are recorded too.
+    # settings (see create_databasev2.OutputSettings) are recorded as well, so those appends have to use the same ones.
+    con          = sqlite3.connect(db_file)
+    converter.RegisterSettings(con,settings)
+    event_offset = 0
+    for run, events in zip(runs,n_events):
+        converter.RegisterSource(con,run,events,event_offset)
+        event_offset += events
+        con.execute('INSERT INTO manifest_chunks VALUES (?,?,?,?)', (run,0,events,time.time()))
+    con.commit()
+    con.close()
+    return
+
+def ConvertRuns(array_paths,db_name,key,gcd_path,outdir,n_workers,df_size = 100000,pragmas = None,schema = 'plain',fit_error = 0.002,
+                layout = 'wide',precision = 'double',storage = 'rows',aggregate = False,progress = False,metrics_path = None,select = None,subsample = None,seed = 0,transform = 'eager',memory_budget = None):
+    #
+    # Converts many i3cols directories into one database. The transformers are fitted on all runs together,
+    # every run is converted into its own shard database by a Pool of n_workers, with event_no continuing
+    # from run to run, and the shards are then merged pairwise in parallel (MergeTree). Runs without events get no shard.
+    # A selection (see create_databasev2.ParseSelection) is applied to every run, with event_no counting all events.
+    # With a memory_budget, df_size and n_workers are planned from the largest run, as every worker converts a whole run.
+    #
+    start_time            = time.time()
+    keys                  = [key] if isinstance(key, str) else list(key)
+    pragmas               = converter.ParsePragmas(pragmas)
+    selection             = converter.ParseSelection(select,subsample,seed)
+    converter.RequirePicklable(selection,'convert_runs')
+    metrics               = Metrics(progress,mode = 'runs',keys = keys,n_workers = n_workers,df_size = df_size,schema = schema,
+                                    layout = layout,precision = precision,storage = storage,aggregate = aggregate,transform = transform,
+                                    select = None if select is None else [str(predicate) for predicate in ([select] if isinstance(select, str) or callable(select) else select)],
+                                    subsample = subsample,seed = seed)
+    runs                  = FindRuns(array_paths)
+    print('FOUND %s RUNS'%len(runs))
+    if memory_budget is not None:
+        largest           = max(runs, key = lambda run: os.path.getsize(run + '/%s/data.npy'%keys[0]))
+        pulses, truth     = converter.OpenArrays(largest,keys,verbose = False)
+        plan              = converter.PlanMemory(pulses,truth,converter.ParseMemory(memory_budget),n_workers,'sharded',fit_error,layout,storage,schema,aggregate,pragmas)
+        del pulses, truth
+        if plan['cache_size'] is not None:
+            pragmas       = dict(pragmas or {}, cache_size = plan['cache_size'])
+        df_size           = plan['df_size']
+        n_workers         = min(plan['n_workers'],len(runs))
+        metrics.info.update(df_size = df_size,n_workers = n_workers,memory_plan = plan)
+    geo                   = converter.GrabGCD(gcd_path)
+    transformer_dict, n_events = converter.SketchRuns(runs,keys,geo,df_size,n_workers,fit_error,metrics,selection)
+    db_path, transformer_path = converter.MakeOutputDirectories(outdir,db_name)
+    converter.SaveTransformers(transformer_dict,transformer_path)
+
+    settings              = []
+    event_base            = 0
+    for j in range(len(runs)):
+        if n_events[j] == 0:
+            # nothing to convert; the run is still recorded in the manifest by RegisterRuns
+            print('SKIPPING %s, IT HOLDS NO EVENTS'%runs[j])
+            continue
+        shard_file        = db_path + '/%s_run%s.db'%(db_name,j)
+        settings.append([runs[j],keys,geo,transformer_dict,shard_file,0,n_events[j],df_size,pragmas,schema,layout,precision,storage,event_base,aggregate,selection,transform])
+        event_base       += n_events[j]
+    shards                = {}
+    n_rows                = 0
+    with metrics.stage('write') as stage:
+        p = Pool(processes = n_workers)
+        for shard_file, first, last, stats in p.imap_unordered(converter.ShardWorker, settings):
+            metrics.add_worker(stats)
+            shards[shard_file] = stats
+            n_rows       += stats['rows']
+            stage.rows   += stats['rows']
+            stage.bytes_written += stats['bytes_written']
+            if not metrics.progress(len(shards),len(settings),n_rows):
+                print('CONVERTED RUN %s / %s'%(len(shards),len(settings)))
+        p.close()
+        p.join()
+
+    tables                = converter.OutputTables(keys,storage,aggregate)
+    with metrics.stage('merge'):
+        merged            = MergeTree([setting[4] for setting in settings],['truth'] + tables,n_workers,pragmas,schema,metrics)
+    db_file               = db_path + '/%s.db'%db_name
+    os.replace(merged,db_file)
+    with metrics.stage('index'):
+        RegisterRuns(db_file,runs,n_events,converter.OutputSettings(keys,layout,schema,storage,precision,aggregate))
+        converter.BuildIndices(db_file,schema)
+    metrics.save(metrics_path if metrics_path is not None else transformer_path + '/metrics.json')
+    print('DONE!')
+    print('Time Elapsed: %s min'%((time.time()-start_time)/60))
+    return db_file
+
+def parse_args(description=__doc__):
+    """Parse command line args"""
+    parser = ArgumentParser(
+        description=description,
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--array_paths', type=str, nargs='+', required=True,
+        help='i3cols directories or glob patterns matching them, e.g. "/data/arrays/run_*"',
+    )
+    parser.add_argument(
+        '--key', type=str, nargs='+', required=True,
+        help='Pulse series to convert, e.g. SplitInIcePulses',
+    )
+    parser.add_argument(
+        '--db_name', type=str, required=True,
+        help='Name of the database',
+    )
+    parser.add_argument(
+        '--gcd_path', type=str, required=True,
+        help='Directory of gcd.pkl',
+    )
+    parser.add_argument(
+        '--outdir', type=str, required=True,
+        help='The database is written to outdir/db_name/data and the transformers to outdir/db_name/meta',
+    )
+    parser.add_argument(
+        '--n_workers', type=int, required=True,
+        help='Number of processes converting runs and merging shards',
+    )
+    parser.add_argument(
+        '--df_size', type=int, default=100000,
+        help='Approximate number of pulses converted and committed at a time',
+    )
+    parser.add_argument(
+        '--pragmas', type=str, nargs='*', default=None,
+        help='SQLite PRAGMAs used while writing, e.g. journal_mode=WAL synchronous=NORMAL',
+    )
+    parser.add_argument(
+        '--schema', type=str, default='plain', choices=['plain', 'indexed'],
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--fit_error', type=float, default=0.002,
+        help='Largest allowed rank error of the quantiles used to fit the transformers',
+    )
+    parser.add_argument(
+        '--layout', type=str, default='wide', choices=['wide', 'compact'],
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--precision', type=str, default='double', choices=['double', 'single'],
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--storage', type=str, default='rows', choices=['rows', 'blob'],
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--aggregate', action='store_true',
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--progress', action='store_true',
+        help='Show a live progress line on stderr',
+    )
+    parser.add_argument(
+        '--metrics_path', type=str, default=None,
+        help='Where to write the JSON metrics. Defaults to outdir/db_name/meta/metrics.json',
+    )
+    parser.add_argument(
+        '--transform', type=str, default='eager', choices=['eager', 'lazy'],
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--select', type=str, nargs='+', default=None,
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--subsample', type=float, default=None,
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='See create_databasev2.py',
+    )
+    parser.add_argument(
+        '--memory_budget', '--memory-budget', type=str, default=None,
+        help='See create_databasev2.py',
+    )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    ConvertRuns(**vars(parse_args()))
@@ -4,14 +4,188 @@ import os
 import sqlite3
 from sklearn.preprocessing import RobustScaler
 import pickle
+import json
+import re
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from sqlalchemy import create_engine
-import sqlalchemy
 import time
+import queue
+import traceback
 from multiprocessing import Pool
+from multiprocessing import shared_memory
 import multiprocessing
+from instrumentation import Metrics, WorkerStats, FileSize, CurrentRSS, TreeRSS
+from transforms import TRANSFORMS_TABLE
+from parquet_writer import ParquetWriter
 
-def FillStack(n_workers,data,df_size,manager,table,db_path):
+# PRAGMAs used while bulk loading. page_size has to come first, as it only takes effect before the first table is created.
+# Durability is traded for speed here; a crashed load has to be redone anyway.
+BULK_PRAGMAS = {'page_size'    : 65536,
+                'journal_mode' : 'OFF',
+                'synchronous'  : 'OFF',
+                'cache_size'   : -1048576,   # negative means KiB, i.e. 1 GiB
+                'temp_store'   : 'MEMORY',
+                'locking_mode' : 'EXCLUSIVE'}
+
+# Streaming and pipeline mode commit once per chunk and record it in the manifest, so an interrupted run can be resumed.
+# That needs commits that survive a killed process, which journal_mode = OFF does not give.
+RESUMABLE_PRAGMAS = {'journal_mode' : 'WAL',
+                     'synchronous'  : 'NORMAL'}
+
+# PRAGMAs restored when a SQLiteWriter is closed, so that the finished database is safe to open and share.
+SAFE_PRAGMAS = {'locking_mode' : 'NORMAL',
+                'journal_mode' : 'DELETE',
+                'synchronous'  : 'FULL'}
+
+def ApplyPragmas(con,pragmas):
+    for pragma in pragmas.keys():
+        con.execute('PRAGMA %s = %s'%(pragma,pragmas[pragma]))
+    return
+
+def BulkPragmas(pragmas = None,resumable = False):
+    settings              = dict(BULK_PRAGMAS)
+    if resumable:
+        settings.update(RESUMABLE_PRAGMAS)
+    if pragmas is not None:
+        settings.update(pragmas)
+    return settings
+
+# Clustered primary keys of the 'indexed' schema. A single INTEGER key becomes the rowid of the table,
+# a composite key makes the table WITHOUT ROWID, so the rows are stored in key order.
+PRIMARY_KEYS = {'truth'    : ['event_no'],
+                'features' : ['event_no', 'pulse_idx'],
+                'doms'     : ['event_no', 'dom_id']}
+
+def PrimaryKeys(table):
+    # Every features_<key> table has the keys of 'features'. None for tables without a clustered key.
+    # Tables of packed events (blob storage) are always keyed by event_no.
+    if table.endswith('_blob'):
+        return ['event_no']
+    if table.startswith('features_'):
+        table = 'features'
+    if table.startswith('doms_'):
+        table = 'doms'
+    return PRIMARY_KEYS.get(table)
+
+class SQLiteWriter:
+    # Bulk-inserts numpy columns straight through sqlite3 with prepared statements and large explicit transactions.
+    # Tables are created on first write from the dtypes of the columns.
+    # With transaction_size = None nothing is committed until commit() is called.
+    # The database keeps a manifest of the committed chunks of every source, so it can be resumed and appended to.
+    supports_manifest = True
+
+    @staticmethod
+    def check_dependencies():
+        return
+
+    def __init__(self,db_file,pragmas = None,transaction_size = 1000000,schema = 'plain'):
+        self.db_file          = db_file
+        self.schema           = schema
+        self.transaction_size = transaction_size
+        self.pending          = 0
+        self.con              = sqlite3.connect(db_file, isolation_level = None)
+        ApplyPragmas(self.con,BulkPragmas(pragmas,resumable = transaction_size is None))
+        self.con.execute('BEGIN')
+
+    def create_table(self,table,columns,keys = None):
+        # keys is the primary key of the table; by default that of the schema (see PrimaryKeys)
+        definitions = []
+        for column in columns.keys():
+            if np.issubdtype(np.asarray(columns[column]).dtype, np.integer):
+                definitions.append('%s INTEGER'%column)
+            elif np.asarray(columns[column]).dtype == object:
+                definitions.append('%s BLOB'%column)
+            elif np.issubdtype(np.asarray(columns[column]).dtype, np.str_):
+                definitions.append('%s TEXT'%column)
+            else:
+                definitions.append('%s REAL'%column)
+        suffix = ''
+        if keys is None and (self.schema == 'indexed' or table.endswith('_blob')):
+            keys = PrimaryKeys(table)
+        if keys is not None:
+            if len(keys) == 1:
+                definitions[list(columns.keys()).index(keys[0])] += ' PRIMARY KEY'
+            else:
+                definitions.append('PRIMARY KEY (%s)'%', '.join(keys))
+                suffix = ' WITHOUT ROWID'
+        self.con.execute('CREATE TABLE IF NOT EXISTS %s (%s)%s'%(table,', '.join(definitions),suffix))
+
+    def insert(self,statement,table,columns,keys = None):
+        # columns is a pd.DataFrame or a dict of equally long numpy arrays
+        if isinstance(columns, pd.DataFrame):
+            columns = {column: columns[column].to_numpy() for column in columns.columns}
+        self.create_table(table,columns,keys)
+        names     = list(columns.keys())
+        statement = '%s INTO %s (%s) VALUES (%s)'%(statement,table,', '.join(names),', '.join(['?']*len(names)))
+        rows      = zip(*[np.asarray(columns[name]).tolist() for name in names])
+        self.con.executemany(statement, rows)
+        return len(columns[names[0]]) if len(names) > 0 else 0
+
+    def write(self,table,columns):
+        self.pending += self.insert('INSERT',table,columns)
+        if self.transaction_size is not None and self.pending >= self.transaction_size:
+            self.commit()
+
+    def has_table(self,table):
+        return len(TableColumns(self.con,table)) > 0
+
+    def write_metadata(self,table,columns,keys):
+        # Tables written once per database besides the events (see WriteMetadata). Rows replace the rows with the same keys.
+        self.insert('INSERT OR REPLACE',table,columns,keys)
+
+    def read_metadata(self,table):
+        # A table written with write_metadata as {column: list}, or None if there is none
+        if not self.has_table(table):
+            return None
+        cursor = self.con.execute('SELECT * FROM %s'%table)
+        names  = [description[0] for description in cursor.description]
+        rows   = cursor.fetchall()
+        return {name: [row[j] for row in rows] for j, name in enumerate(names)}
+
+    def register_settings(self,settings):
+        RegisterSettings(self.con,settings)
+
+    def register_source(self,source,n_events):
+        return RegisterSource(self.con,source,n_events)
+
+    def committed_chunks(self,source):
+        return CommittedChunks(self.con,source)
+
+    def commit_chunk(self,source,first,last):
+        # Records the chunk in the manifest in the same transaction as its rows, then commits both
+        self.con.execute('INSERT INTO manifest_chunks VALUES (?,?,?,?)', (source,first,last,time.time()))
+        self.commit()
+
+    def commit(self):
+        self.con.execute('COMMIT')
+        self.con.execute('BEGIN')
+        self.pending = 0
+
+    def close(self):
+        self.con.execute('COMMIT')
+        ApplyPragmas(self.con,SAFE_PRAGMAS)
+        self.con.close()
+
+    def finish(self):
+        # Closes the finished database and prepares it for reading
+        self.close()
+        BuildIndices(self.db_file,self.schema)
+
+# Output backends of streaming and pipeline mode. A backend is a writer class taking (path, pragmas, transaction_size, schema)
+# with the methods of SQLiteWriter: write(table, columns), commit(), close() and finish() for the events, where commit() ends
+# the chunk, has_table, write_metadata and read_metadata for the tables of WriteMetadata, and register_settings, register_source,
+# committed_chunks and commit_chunk for the manifest. Backends with supports_manifest = False number the events of their single source from 1
+# and cannot be resumed or appended to. check_dependencies() raises if the backend cannot be used.
+OUTPUT_BACKENDS   = {'sqlite'  : SQLiteWriter,
+                     'parquet' : ParquetWriter}
+OUTPUT_EXTENSIONS = {'sqlite'  : '.db',
+                     'parquet' : '.parquet'}
+
+def OpenWriter(db_file,backend = 'sqlite',pragmas = None,schema = 'plain'):
+    # Writer of the backend for the output db_file (<db_name>.db), committing only when told to
+    path = os.path.splitext(db_file)[0] + OUTPUT_EXTENSIONS[backend]
+    return OUTPUT_BACKENDS[backend](path,pragmas,transaction_size = None,schema = schema)
+
+def FillStack(n_workers,data,df_size,manager,table,db_path,pragmas = None):
     data = data.reset_index(drop = True)
     print('This StackFiller Recieved %s events'%len(pd.unique(data['event_no'])))
     settings = []
@@ -21,7 +195,7 @@ def FillStack(n_workers,data,df_size,manager,table,db_path):
         print('joblist[%s][0] = %s || joblist[%s][1] = %s'%(j,job_list[j][0],j, job_list[j][1]))
         chunk =  data.loc[job_list[j][0]:job_list[j][1],:]
         
-        db_path_tmp = db_path.split('.')[0] + '_tmp-%s.db'%str(j) 
+        db_path_tmp = os.path.splitext(db_path)[0] + '_tmp-%s.db'%str(j) 
         n_appends  = int(np.ceil(len(chunk['event_no'])/df_size))
         
         #for k in range(0,n_appends):
@@ -34,10 +208,50 @@ def FillStack(n_workers,data,df_size,manager,table,db_path):
         #        data_batch           = chunk.loc[k*df_size:up,:]
         #        q.put(data_batch)
         q.put(chunk)
-        settings.append([db_path_tmp,table,q,n_appends,n_workers]) 
+        settings.append([db_path_tmp,table,q,n_appends,n_workers,pragmas]) 
     
     return settings  #settings
 
+def ShareColumns(data):
+    # Copies every column of data once into its own multiprocessing.shared_memory block.
+    # Returns the blocks, which the caller must close and unlink, and picklable [column, block name, dtype, length] descriptors.
+    blocks  = []
+    columns = []
+    for column in data.columns:
+        values = np.ascontiguousarray(data[column].to_numpy())
+        block  = shared_memory.SharedMemory(create = True, size = max(values.nbytes,1))
+        np.ndarray(values.shape, dtype = values.dtype, buffer = block.buf)[:] = values
+        blocks.append(block)
+        columns.append([column, block.name, values.dtype.str, len(values)])
+    return blocks, columns
+
+def AttachColumns(columns):
+    # Maps the shared_memory blocks described by ShareColumns as numpy arrays without copying
+    blocks  = []
+    arrays  = {}
+    for column, name, dtype, length in columns:
+        block  = shared_memory.SharedMemory(name = name)
+        blocks.append(block)
+        arrays[column] = np.ndarray((length,), dtype = dtype, buffer = block.buf)
+    return blocks, arrays
+
+def ReleaseColumns(blocks,unlink = False):
+    for block in blocks:
+        block.close()
+        if unlink:
+            block.unlink()
+    return
+
+def FillSharedStack(n_workers,data,columns,df_size,table,db_path,pragmas = None):
+    # Same split as FillStack, but the workers only receive row offsets into the shared columns
+    settings = []
+    job_list = SplitIndicies(data,n_workers,exclude_initial = True)
+    for j in range(len(job_list)):
+        print('joblist[%s][0] = %s || joblist[%s][1] = %s'%(j,job_list[j][0],j, job_list[j][1]))
+        db_path_tmp = os.path.splitext(db_path)[0] + '_tmp-%s.db'%str(j)
+        settings.append([db_path_tmp,table,columns,job_list[j][0],job_list[j][1],df_size,pragmas])
+    return settings
+
 def MergeTemporaries(path):
     files = os.listdir(path)
     tmp = []
@@ -50,6 +264,41 @@ def MergeTemporaries(path):
 
     return [main_db, tmp]
 
+def TableColumns(con,table,database = 'main'):
+    return [row[1] for row in con.execute('PRAGMA %s.table_info(%s)'%(database,table))]
+
+def MergeShards(main_db,shards,tables,delete_shards = False,pragmas = None,schema = 'plain',progress = None):
+    # Copies the tables of each shard into main_db inside SQLite: the shard is attached and
+    # every table is moved with a single INSERT ... SELECT, so no rows pass through Python.
+    # progress(done, total, rows), e.g. Metrics.progress, is called after every shard instead of printing a line.
+    con = sqlite3.connect(main_db, isolation_level = None)
+    ApplyPragmas(con,BulkPragmas(pragmas))
+    rows = 0
+    for j in range(0,len(shards)):
+        con.execute('ATTACH DATABASE ? AS shard', (shards[j],))
+        con.execute('BEGIN')
+        for table in tables:
+            columns = TableColumns(con,table,'shard')
+            if len(columns) == 0:
+                continue
+            if len(TableColumns(con,table)) == 0:
+                con.execute('CREATE TABLE main.%s AS SELECT * FROM shard.%s WHERE 0'%(table,table))
+            columns = ', '.join(columns)
+            order   = ''
+            if schema == 'indexed' and PrimaryKeys(table) is not None:
+                # the shards are plain tables; feeding the clustered table in key order keeps the B-tree appends sequential
+                order = ' ORDER BY %s'%', '.join(PrimaryKeys(table))
+            rows   += con.execute('INSERT INTO main.%s (%s) SELECT %s FROM shard.%s%s'%(table,columns,columns,table,order)).rowcount
+        con.execute('COMMIT')
+        con.execute('DETACH DATABASE shard')
+        if delete_shards:
+            os.remove(shards[j])
+        if progress is None or not progress(j+1,len(shards),rows):
+            print('MERGING %s / %s'%(j+1,len(shards)))
+    ApplyPragmas(con,SAFE_PRAGMAS)
+    con.close()
+    return
+
 def WorkForeman(workers):
     worker_status = 0
     for i in range(0,len(workers)):
@@ -62,46 +311,1229 @@ def WorkForeman(workers):
         return True
         
 def GrabGCD(path):
+    # path is either an entry of the geometry cache written by i3ToNumpy/create_geo_array.py --cache-dir, i.e.
+    # <cache_dir>/<md5 of the GCD .i3 file>, whose geo.npy is memory-mapped, or a directory holding one gcd .pkl
     print('GRABBING GEO-SPATIAL DATA')
-    files = os.listdir(path)
-    for file in files:
-        if file.endswith('.pkl'):
-            gcd = pd.read_pickle(path + '//' + file)
+    if os.path.isfile(path + '/geo.npy'):
+        return np.load(path + '/geo.npy', mmap_mode = 'r')
+    files = [file for file in os.listdir(path) if file.endswith('.pkl')]
+    if len(files) != 1:
+        entries = [entry for entry in os.listdir(path) if os.path.isfile(path + '/' + entry + '/geo.npy')]
+        raise ValueError('%s holds %s .pkl files %s. Pass a directory with one of them, or a geometry cache entry %s'%(path,len(files),files,[path + '/' + entry for entry in entries]))
+    gcd = pd.read_pickle(path + '//' + files[0])
     return gcd['geo']
 
 def WriteToDB(settings):
-    db_path, table, q,n_appends,n_workers = settings
-    engine = sqlalchemy.create_engine(db_path)
-    queue_empty = q.empty()
-    print(queue_empty)
+    db_path, table, q,n_appends,n_workers,pragmas = settings
+    start  = time.time()
+    size   = FileSize(db_path)
+    rows   = 0
+    writer = SQLiteWriter(db_path,pragmas)
     chunk_counter  = 1
-    while(queue_empty != True):
+    # All workers of a table share q, so another worker may take the last chunk between an empty() check and a
+    # blocking get(). get_nowait() takes a chunk or tells that none are left, in one step.
+    while True:
+        try:
+            data_batch = q.get_nowait()
+        except queue.Empty:
+            break
         print('INSERTING IN %s : %s  / %s '%(table,chunk_counter, n_appends))
-        data_batch = q.get() 
-        data_batch.to_sql(table,engine,index= False, if_exists = 'append',chunksize = len(data_batch))
+        writer.write(table,data_batch)
+        rows += len(data_batch)
         chunk_counter += 1
-        queue_empty = q.empty()
         
-    engine.dispose() 
+    writer.close()
 
-    return
+    return WorkerStats('write %s'%table,start,rows,FileSize(db_path) - size)
+
+def WriteSharedToDB(settings):
+    db_path, table, columns, first, last, df_size, pragmas = settings
+    start  = time.time()
+    size   = FileSize(db_path)
+    blocks, arrays = AttachColumns(columns)
+    writer = SQLiteWriter(db_path,pragmas)
+    n_appends = int(np.ceil((last + 1 - first)/df_size))
+    for k in range(0,n_appends):
+        print('INSERTING IN %s : %s  / %s '%(table,k + 1, n_appends))
+        up = min(first + (k + 1)*df_size, last + 1)
+        writer.write(table,{column: arrays[column][first + k*df_size:up] for column in arrays.keys()})
+    writer.close()
+    del arrays
+    ReleaseColumns(blocks)
+    return WorkerStats('write %s'%table,start,last + 1 - first,FileSize(db_path) - size)
 
 def SplitIndicies(data,n_workers,exclude_initial = True):
+    # Splits the rows of data into at most n_workers inclusive [first, last] ranges for data.loc.
+    # With exclude_initial the rows 0-10 are left out, as they are written by the initial commit (data.loc[0:10]).
     if exclude_initial == True:
-        n_rows         = np.arange(11,len(data)-1)
+        n_rows         = np.arange(11,len(data))
     else:
-        n_rows         = np.arange(0,len(data)-1)
+        n_rows         = np.arange(0,len(data))
     chunks         = np.array_split(n_rows,n_workers)
     
     split_indicies = []
     n_events = 0
     for chunk in chunks:
+        if len(chunk) == 0:
+            continue
         split_indicies.append([chunk[0],chunk[-1]])
         n_events += len(chunk)
     print('total amount of events in Splits: %s '%n_events)
     return split_indicies
     
 
+def EventChunks(data_index,df_size):
+    # Cuts the events in index.npy into consecutive chunks of roughly df_size pulses each.
+    # Chunks never split an event, so every chunk can be transformed and written on its own. No events give no chunks.
+    if len(data_index) == 0:
+        return []
+    stops          = np.asarray(data_index['stop'], dtype = np.int64)
+    first_pulse    = int(data_index['start'][0])
+    boundaries     = np.arange(first_pulse + df_size, stops[-1], df_size)
+    event_cuts     = np.unique(np.searchsorted(stops, boundaries, side = 'left') + 1)
+    event_cuts     = event_cuts[(event_cuts > 0) & (event_cuts < len(data_index))]
+    edges          = np.concatenate([[0], event_cuts, [len(data_index)]])
+    chunks = []
+    for k in range(len(edges) - 1):
+        chunks.append([int(edges[k]), int(edges[k + 1])])
+    return chunks
+
+# Rough sizes used by PlanMemory. Every value handed to executemany becomes a Python object (24 bytes for a float)
+# behind an 8 byte list pointer, and the float64 columns of a chunk exist about twice while they are transformed.
+PYTHON_VALUE_BYTES = 32
+COLUMN_COPIES      = 2
+MIN_DF_SIZE        = 10000   # smallest chunk, in pulses, PlanMemory uses before it drops a worker
+CHUNKS_PER_WORKER  = 4       # pipeline mode gets at least this many chunks per producer, so that they all stay busy
+THROTTLE_FRACTION  = 0.9     # pipeline producers wait while the processes hold more than this fraction of the memory budget
+CACHE_FRACTION     = 0.25    # share of the memory budget given to the SQLite page caches of the writers, unless --pragmas sets cache_size
+
+def ParseMemory(memory):
+    # '16G', '500MB', '2048K' or a number of bytes -> bytes
+    units  = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    memory = str(memory).strip().upper()
+    if memory.endswith('B'):
+        memory = memory[:-1]
+    if memory[-1:] in units:
+        return int(float(memory[:-1])*units[memory[-1]])
+    return int(float(memory))
+
+def CacheBytes(pragmas = None):
+    # Largest size of the SQLite page cache of one writer with the bulk PRAGMAs and the overrides in pragmas.
+    # The cache fills up as the database grows, so a long load ends up holding all of it.
+    settings   = BulkPragmas(pragmas)
+    cache_size = int(settings['cache_size'])
+    if cache_size < 0:
+        return -cache_size*1024   # KiB
+    return cache_size*int(settings['page_size'])
+
+def Writers(mode,n_workers):
+    # Processes of a mode that write through SQLiteWriter at the same time
+    if mode == 'sharded':
+        return n_workers
+    if mode == 'batch':
+        return n_workers + 1   # the temporary databases, and the main database while they are merged
+    return 1
+
+def ChunkBytes(pulses,truth,layout = 'wide',storage = 'rows',schema = 'plain',aggregate = False):
+    # Estimated bytes held per pulse (counted in the first key, like df_size) and per event while a chunk is converted
+    # and written, from the dtypes of the arrays and the columns that are written. The last two values are the part of
+    # them that is still held while a converted chunk waits on the queue of pipeline mode.
+    keys          = list(pulses.keys())
+    n_first       = max(1,len(pulses[keys[0]][0]))
+    n_columns     = (2 + len(FEATURE_COLUMNS[3:]) if layout == 'compact' else 1 + len(FEATURE_COLUMNS)) + int(schema == 'indexed' and storage == 'rows')
+    n_doms        = 5 + (0 if layout == 'compact' else 3)
+    python_bytes  = 0 if storage == 'blob' else PYTHON_VALUE_BYTES   # blobs are written one row per event
+    pulse_bytes   = 0.0
+    queued_pulse  = 0.0
+    for key in keys:
+        share         = len(pulses[key][0])/n_first
+        pulse_bytes  += share*(pulses[key][0].dtype.itemsize + n_columns*(8*COLUMN_COPIES + python_bytes))
+        queued_pulse += share*n_columns*8
+        if aggregate:
+            # at most one doms row per pulse
+            pulse_bytes  += share*n_doms*(8*COLUMN_COPIES + PYTHON_VALUE_BYTES)
+            queued_pulse += share*n_doms*8
+    n_truth       = len(ExtractTruth(truth[:0]).columns)
+    event_bytes   = truth.dtype.itemsize + n_truth*(8*COLUMN_COPIES + PYTHON_VALUE_BYTES)
+    return pulse_bytes, event_bytes, queued_pulse, n_truth*8
+
+def PlanMemory(pulses,truth,memory_budget,n_workers,mode,fit_error = 0.002,layout = 'wide',storage = 'rows',schema = 'plain',aggregate = False,pragmas = None,backend = 'sqlite'):
+    # Picks df_size and the number of workers (at most n_workers) so that the chunks all processes of the mode hold
+    # at once fill memory_budget (bytes). Every process is assumed to need what this one holds now (interpreter, modules),
+    # and fitting the transformers is planned as its own phase, with a sketch per table in every process.
+    # Every SQLite writer also holds its page cache. If pragmas sets cache_size that size is counted, otherwise the caches
+    # are given CACHE_FRACTION of the budget and the plan holds the cache_size PRAGMA to write with.
+    # Prefers more workers over larger chunks, down to chunks of MIN_DF_SIZE pulses. Returns the plan as a dict.
+    data_index    = pulses[list(pulses.keys())[0]][1]
+    n_events      = len(data_index)
+    n_pulses      = int(data_index['stop'][-1]) - int(data_index['start'][0]) if n_events > 0 else 0
+    pulse_bytes, event_bytes, queued_pulse, queued_event = ChunkBytes(pulses,truth,layout,storage,schema,aggregate)
+    # everything per pulse of the first key, with the events of a chunk spread over its pulses
+    per_pulse     = pulse_bytes + event_bytes*n_events/max(1,n_pulses)
+    per_queued    = queued_pulse + queued_event*n_events/max(1,n_pulses)
+    # sketching holds the pulses, their features and their row numbers
+    n_first       = max(1,len(pulses[list(pulses.keys())[0]][0]))
+    per_sketched  = sum([(pulses[key][0].dtype.itemsize + (2 + len(FEATURE_COLUMNS))*8*COLUMN_COPIES)*len(pulses[key][0])/n_first for key in pulses.keys()])
+    process_bytes = CurrentRSS()*2**20
+    # a running sketch collects up to twice SketchSize rows of every table (values and a priority) before it is cut back
+    size          = 2*SketchSize(fit_error)
+    sketch_bytes  = sum([min(size,len(pulses[key][0]))*(1 + len(FEATURE_COLUMNS)) for key in pulses.keys()])*8*COLUMN_COPIES
+    sketch_bytes += min(size,n_events)*(1 + len(ExtractTruth(truth[:0]).columns))*8*COLUMN_COPIES
+    smallest      = min(MIN_DF_SIZE,max(1,n_pulses))
+    fixed_cache   = pragmas is not None and 'cache_size' in pragmas
+
+    def CachePlan(workers):
+        # bytes of the page caches of all writers, and the cache_size PRAGMA of the plan (None if not planned here)
+        if backend != 'sqlite':
+            return 0, None
+        writers   = Writers(mode,workers)
+        if fixed_cache:
+            return writers*CacheBytes(pragmas), None
+        cache     = min(CacheBytes(),int(CACHE_FRACTION*memory_budget/writers))
+        return writers*cache, -max(1,cache//1024)
+
+    if mode == 'batch':
+        # everything is in memory at once: the arrays, their DataFrames and the copies handed to the workers
+        cache_bytes, cache_size = CachePlan(n_workers)
+        needed    = process_bytes + n_pulses*per_pulse*COLUMN_COPIES + cache_bytes
+        if needed > memory_budget:
+            raise ValueError('batch mode needs about %.0f MB for %s pulses, more than the memory budget of %.0f MB. Use --mode streaming, pipeline or sharded'%(needed/2**20,n_pulses,memory_budget/2**20))
+        print('MEMORY BUDGET %.0f MB: BATCH MODE NEEDS ABOUT %.0f MB, OF WHICH %.0f MB SQLITE CACHE'%(memory_budget/2**20,needed/2**20,cache_bytes/2**20))
+        return {'mode': mode, 'df_size': None, 'n_workers': n_workers, 'bytes_per_pulse': per_pulse, 'cache_mb': cache_bytes/2**20, 'cache_size': cache_size, 'estimated_mb': needed/2**20}
+    for workers in range(max(1,n_workers), 0, -1):
+        cache_bytes, cache_size = CachePlan(workers)
+        # bytes = fixed + df_size*per chunk pulse, for fitting (every worker sketches one chunk at a time, the parent merges
+        # their sketches) and for writing
+        fit_fixed     = (workers + 1)*(process_bytes + sketch_bytes)
+        fit_per       = workers*per_sketched
+        if mode == 'pipeline':
+            # a chunk per producer, up to 2*n_workers converted chunks on the queue and the chunk being written
+            write_fixed = (workers + 1)*process_bytes
+            write_per   = (workers + 1)*per_pulse + 2*workers*per_queued
+            cap         = int(np.ceil(n_pulses/(CHUNKS_PER_WORKER*workers)))
+        elif mode == 'sharded':
+            write_fixed = (workers + 1)*process_bytes
+            write_per   = workers*per_pulse
+            cap         = int(np.ceil(n_pulses/workers))
+        else:
+            write_fixed = process_bytes
+            write_per   = per_pulse
+            cap         = n_pulses
+        write_fixed  += cache_bytes
+        # (arrays without pulses cost nothing per pulse, but still need a df_size)
+        df_size       = int(min((memory_budget - fit_fixed)/max(1.0,fit_per),(memory_budget - write_fixed)/max(1.0,write_per)))
+        if df_size >= smallest:
+            df_size   = max(1,min(df_size,cap))
+            estimated = max(fit_fixed + df_size*fit_per,write_fixed + df_size*write_per)
+            print('MEMORY BUDGET %.0f MB: %s WORKERS, CHUNKS OF %s PULSES (ABOUT %.0f BYTES PER PULSE, %.0f MB SQLITE CACHE, %.0f MB AT MOST)'%(memory_budget/2**20,workers,df_size,per_pulse,cache_bytes/2**20,estimated/2**20))
+            return {'mode': mode, 'df_size': df_size, 'n_workers': workers, 'bytes_per_pulse': per_pulse, 'process_mb': process_bytes/2**20, 'cache_mb': cache_bytes/2**20, 'cache_size': cache_size, 'estimated_mb': estimated/2**20}
+    raise ValueError('A memory budget of %.0f MB is too small: one worker with chunks of %s pulses needs more. Each process alone takes about %.0f MB, and the SQLite page caches %.0f MB (see cache_size in --pragmas)'%(memory_budget/2**20,smallest,process_bytes/2**20,CachePlan(1)[0]/2**20))
+
+def Throttle(gate,workers,memory_budget,results):
+    # Pipeline mode: closes the gate of the producers while the writer and the producers together hold more than
+    # THROTTLE_FRACTION of memory_budget, as long as converted chunks are waiting; writing them is what frees memory.
+    # Returns True if the gate was closed by this call.
+    if TreeRSS([os.getpid()] + [worker.pid for worker in workers])*2**20 > THROTTLE_FRACTION*memory_budget and not results.empty():
+        if gate.is_set():
+            gate.clear()
+            return True
+        return False
+    gate.set()
+    return False
+
+# Columns of the features tables after event_no, filled by FeatureColumns
+FEATURE_COLUMNS = ['dom_x',
+                   'dom_y',
+                   'dom_z',
+                   'dom_time',
+                   'charge_log10']
+
+# Truth columns that are written as they are. direction_x/y/z are components of a unit vector, so they are not scaled either.
+UNSCALED_TRUTH = ['event_no','pid','direction_x','direction_y','direction_z']
+
+# Comparisons allowed in the predicates of --select. 'in' takes a comma separated list of values.
+SELECTION_OPERATORS = {'==' : np.equal,
+                       '!=' : np.not_equal,
+                       '<=' : np.less_equal,
+                       '>=' : np.greater_equal,
+                       '<'  : np.less,
+                       '>'  : np.greater,
+                       'in' : np.isin}
+
+def ParseSelection(select = None,subsample = None,seed = 0):
+    # --select, --subsample and --seed -> the selection handed to the converters, or None if every event is kept.
+    # select holds predicates on the fields of MCInIcePrimary, e.g. 'energy>10', 'pdg_encoding in 14,-14' or 'dir.zenith<1.5',
+    # or functions taking a chunk of the truth array and returning a boolean mask. An event is kept if all of them hold.
+    if select is None:
+        select = []
+    elif isinstance(select, str) or callable(select):
+        select = [select]
+    if len(select) == 0 and subsample is None:
+        return None
+    predicates = []
+    for predicate in select:
+        if callable(predicate):
+            predicates.append(predicate)
+            continue
+        match = re.match(r'^\s*([A-Za-z_][\w.]*)\s*(==|!=|<=|>=|<|>|in\b)\s*(\S.*?)\s*$', predicate)
+        if match is None:
+            raise ValueError('Cannot parse the selection %s. Use e.g. energy>10 or pdg_encoding in 14,-14'%predicate)
+        field, operator, values = match.groups()
+        values = [float(value) for value in values.split(',')]
+        if operator != 'in' and len(values) != 1:
+            raise ValueError('%s compares with one value, use in for several'%predicate)
+        predicates.append([field.split('.'), operator, np.array(values) if operator == 'in' else values[0]])
+    if subsample is not None and not 0 < subsample <= 1:
+        raise ValueError('subsample must be in (0, 1], not %s'%subsample)
+    return {'predicates': predicates, 'subsample': subsample, 'seed': seed}
+
+def RequirePicklable(selection,mode):
+    # Every mode but batch hands the selection to worker processes (for fitting, and in pipeline and sharded mode for
+    # converting), which only works for functions that pickle, i.e. that are defined at module level
+    if selection is None:
+        return
+    for predicate in selection['predicates']:
+        if callable(predicate):
+            try:
+                pickle.dumps(predicate)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                raise ValueError('The selection function %r cannot be pickled, so %s mode cannot hand it to its worker processes. Define it at module level'%(predicate,mode))
+    return
+
+def SelectEvents(truth,event_offset,selection):
+    # Positions of the events of the truth chunk that pass the selection. event_offset is as in ExtractTruth.
+    # Subsampling keeps an event if the RowPriorities of its event_no is below subsample*2^64,
+    # so the same events are kept however the events are chunked and whichever worker converts them.
+    mask = np.ones(len(truth), dtype = bool)
+    for predicate in selection['predicates']:
+        if callable(predicate):
+            mask &= np.asarray(predicate(truth), dtype = bool)
+            continue
+        path, operator, value = predicate
+        column = truth
+        for field in path:
+            if column.dtype.names is None or field not in column.dtype.names:
+                raise ValueError('%s is not a field of the truth array, which has %s'%('.'.join(path),truth.dtype.names))
+            column = column[field]
+        mask &= SELECTION_OPERATORS[operator](column, value)
+    if selection['subsample'] is not None and selection['subsample'] < 1:
+        threshold = np.uint64(min(int(selection['subsample']*2.0**64), 2**64 - 1))
+        mask &= RowPriorities(np.arange(event_offset + 1,event_offset + len(truth) + 1),selection['seed']) < threshold
+    return np.flatnonzero(mask)
+
+def SelectPulses(data,data_index,selected):
+    # Reads only the pulses of the events data_index[selected] from data, event after event.
+    # Returns them, an index of the same events pointing into them (as ExtractFeatures expects) and their rows in data.
+    starts          = np.asarray(data_index['start'], dtype = np.int64)[selected]
+    lengths         = np.asarray(data_index['stop'], dtype = np.int64)[selected] - starts
+    offsets         = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    rows            = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    hits_idx        = np.empty(len(starts), dtype = data_index.dtype)
+    hits_idx['start'] = offsets[:-1]
+    hits_idx['stop']  = offsets[1:]
+    return data[rows], hits_idx, rows
+
+def ExtractTruth(truth,event_offset = 0,event_no = None):
+    # event_offset is the position of truth[0] in the full MCInIcePrimary array. Event numbers start at 1.
+    # For a selection of events event_no gives the event number of every row instead.
+    # The columns are views of the fields of the structured array, so nothing is copied until the rows are written.
+    zenith          = truth['dir']['zenith']
+    azimuth         = truth['dir']['azimuth']
+    sin_zenith      = np.sin(zenith)
+    columns         = {'event_no'          : np.arange(event_offset + 1,event_offset + len(truth) + 1) if event_no is None else event_no,
+                       'energy_log10'      : truth['energy'],
+                       'time'              : truth['time'],
+                       'position_x'        : truth['pos']['x'],
+                       'position_y'        : truth['pos']['y'],
+                       'position_z'        : truth['pos']['z'],
+                       'azimuth'           : azimuth,
+                       'zenith'            : zenith,
+                       'pid'               : truth['pdg_encoding'],
+                       'muon_track_length' : truth['length'],
+                       # direction of travel, i.e. opposite to where the particle comes from (as I3Direction)
+                       'direction_x'       : -sin_zenith*np.cos(azimuth),
+                       'direction_y'       : -sin_zenith*np.sin(azimuth),
+                       'direction_z'       : -np.cos(zenith)}
+    return pd.DataFrame(columns, copy = False)
+
+def FeatureColumns(hits,geo,event_no = None):
+    # All columns are filled into one preallocated array, which the DataFrame wraps without copying.
+    # If event_no is given it becomes the first column.
+    first               = 0 if event_no is None else 1
+    single_hits         = np.empty((len(hits), first + len(FEATURE_COLUMNS)))
+    if event_no is not None:
+        single_hits[:, 0] = event_no
+    string_idx          = hits['key']['string'] - 1
+    om_idx              = hits['key']['om'] - 1
+    single_hits[:, first:first + 3] = geo[string_idx, om_idx]
+    single_hits[:, first + 3]       = hits['pulse']['time']
+    single_hits[:, first + 4]       = hits['pulse']['charge']
+    return pd.DataFrame(single_hits, columns = ['event_no']*first + FEATURE_COLUMNS, copy = False)
+
+def AddPulseIndex(features):
+    # Adds pulse_idx, the position of each pulse within its event, and makes event_no an integer.
+    # Assumes the pulses of an event are consecutive rows, as they are in data.npy.
+    event_no            = features['event_no'].to_numpy().astype(np.int64)
+    n_pulses            = len(event_no)
+    starts              = np.flatnonzero(np.concatenate([[True], event_no[1:] != event_no[:-1]])) if n_pulses > 0 else np.array([], dtype = np.int64)
+    lengths             = np.diff(np.concatenate([starts, [n_pulses]]))
+    features['event_no'] = event_no
+    features.insert(1,'pulse_idx',np.arange(n_pulses) - np.repeat(starts, lengths))
+    return features
+
+def BuildIndices(db_file,schema = 'plain'):
+    # Runs once after the bulk load. Tables in the 'indexed' schema are already clustered by their primary keys,
+    # so this only gathers statistics for the query planner there; 'plain' tables are left as they are.
+    if schema == 'indexed':
+        print('ANALYZING %s'%db_file)
+        con = sqlite3.connect(db_file)
+        con.execute('ANALYZE')
+        con.close()
+    return
+
+def ExtractFeatures(hits,hits_idx,geo,event_offset = 0,event_no = None):
+    # hits must be the pulses hits_idx[0]['start'] : hits_idx[-1]['stop'] of data.npy, with the events stored back to back.
+    # event_no is the event number of each event of hits_idx, as in ExtractTruth.
+    starts              = np.asarray(hits_idx['start'], dtype = np.int64)
+    stops               = np.asarray(hits_idx['stop'], dtype = np.int64)
+    if np.any(starts[1:] != stops[:-1]) or (len(stops) > 0 and stops[-1] - starts[0] != len(hits)):
+        raise ValueError('The pulses of the events in index.npy are not stored back to back')
+    if event_no is None:
+        event_no        = np.arange(event_offset + 1,event_offset + len(hits_idx) + 1)
+    event_no            = np.repeat(event_no, stops - starts)
+    return FeatureColumns(hits,geo,event_no)
+
+def DomIds(hits,geo):
+    # Row of each pulse's DOM in geo.reshape(-1, 3), i.e. (string - 1)*n_oms + om - 1
+    return (hits['key']['string'].astype(np.int64) - 1)*geo.shape[1] + hits['key']['om'].astype(np.int64) - 1
+
+def CompactFeatures(features,dom_id):
+    # Compact layout: integer event_no and dom_id instead of the float64 dom_x, dom_y, dom_z of every pulse.
+    # The DOM positions are stored once, in the geometry table.
+    columns = {'event_no': features['event_no'].to_numpy().astype(np.int64), 'dom_id': dom_id}
+    for column in FEATURE_COLUMNS[3:]:
+        columns[column] = features[column].to_numpy()
+    return pd.DataFrame(columns, copy = False)
+
+def GeometryTable(table):
+    # Geometry table belonging to a features table: features -> geometry, features_<key> -> geometry_<key>
+    return 'geometry' + table[len('features'):]
+
+def WriteGeometry(writer,geo,tables,transformer_dict,precision = 'double'):
+    # Writes the DOM positions of the compact layout, once per features table, as its transformers scale dom_x/y/z
+    # differently. Tables that already exist (e.g. when resuming) are left as they are.
+    n_strings, n_oms = geo.shape[0], geo.shape[1]
+    for table in tables:
+        geometry       = GeometryTable(table)
+        if writer.has_table(geometry):
+            continue
+        positions      = pd.DataFrame({'dom_id': np.arange(n_strings*n_oms),
+                                       'string': np.repeat(np.arange(1,n_strings + 1),n_oms),
+                                       'om': np.tile(np.arange(1,n_oms + 1),n_strings)})
+        for j in range(3):
+            positions[FEATURE_COLUMNS[j]] = geo.reshape(-1, 3)[:, j]
+        positions      = SetPrecision(ApplyTransformers(positions,transformer_dict[InputSection(table)]),precision)
+        writer.write_metadata(geometry,positions,['dom_id'])
+    return
+
+def DomTable(table):
+    # Per-DOM summary table belonging to a features table: features -> doms, features_<key> -> doms_<key>
+    return 'doms' + table[len('features'):]
+
+def DomSummary(hits,hits_idx,geo,event_offset = 0,layout = 'wide',event_no = None):
+    # One row per (event, DOM) that was hit: the time of its first pulse, the sum of its charges and its number of pulses,
+    # computed from the raw pulses with segmented reductions. hits must be as in ExtractFeatures.
+    lengths         = np.asarray(hits_idx['stop'], dtype = np.int64) - np.asarray(hits_idx['start'], dtype = np.int64)
+    dom_id          = DomIds(hits,geo)
+    n_doms          = geo.shape[0]*geo.shape[1]
+    segment         = np.repeat(np.arange(len(hits_idx), dtype = np.int64), lengths)*n_doms + dom_id
+    order           = np.argsort(segment, kind = 'stable')
+    segment         = segment[order]
+    starts          = np.flatnonzero(np.concatenate([[True], segment[1:] != segment[:-1]])) if len(segment) > 0 else np.array([], dtype = np.int64)
+    if event_no is None:
+        event_no    = np.arange(event_offset + 1,event_offset + len(hits_idx) + 1)
+    summary         = {'event_no': np.asarray(event_no, dtype = np.int64)[segment[starts]//n_doms],
+                       'dom_id': segment[starts]%n_doms}
+    if layout != 'compact':
+        positions   = geo.reshape(-1, 3)[summary['dom_id']]
+        for j in range(3):
+            summary[FEATURE_COLUMNS[j]] = positions[:, j]
+    if len(starts) > 0:
+        summary['first_time']   = np.minimum.reduceat(np.asarray(hits['pulse']['time'], dtype = np.float64)[order], starts)
+        summary['total_charge'] = np.add.reduceat(np.asarray(hits['pulse']['charge'], dtype = np.float64)[order], starts)
+    else:
+        summary['first_time']   = np.array([], dtype = np.float64)
+        summary['total_charge'] = np.array([], dtype = np.float64)
+    summary['n_hits']           = np.diff(np.append(starts, len(segment)))
+    return pd.DataFrame(summary, copy = False)
+
+def OutputTables(keys,storage = 'rows',aggregate = False):
+    # Event tables written besides truth
+    tables = []
+    for table in FeatureTables(keys).values():
+        tables.append(BlobTable(table) if storage == 'blob' else table)
+        if aggregate:
+            tables.append(DomTable(table))
+    return tables
+
+def BlobTable(table):
+    # Table of packed events belonging to a features table: features -> features_blob
+    return table + '_blob'
+
+def BlobDtype(layout = 'wide',precision = 'double'):
+    # Fixed dtype of one packed pulse. event_no is the key of the row and pulse_idx the position in the blob, so neither is stored.
+    real    = '<f4' if precision == 'single' else '<f8'
+    if layout == 'compact':
+        return np.dtype([('dom_id', '<i4')] + [(column, real) for column in FEATURE_COLUMNS[3:]])
+    return np.dtype([(column, real) for column in FEATURE_COLUMNS])
+
+def PackEvents(features,dtype):
+    # Blob storage: one row per event with its pulse count and its pulses as a single buffer of dtype.
+    # The pulses of an event must be consecutive rows, as they are after ExtractFeatures.
+    event_no        = features['event_no'].to_numpy().astype(np.int64)
+    packed          = np.empty(len(event_no), dtype = dtype)
+    for column in dtype.names:
+        packed[column] = features[column].to_numpy()
+    starts          = np.flatnonzero(np.concatenate([[True], event_no[1:] != event_no[:-1]])) if len(event_no) > 0 else np.array([], dtype = np.int64)
+    stops           = np.append(starts[1:], len(event_no))
+    buffer          = packed.tobytes()
+    size            = dtype.itemsize
+    blobs           = np.empty(len(starts), dtype = object)
+    blobs[:]        = [buffer[start*size:stop*size] for start, stop in zip(starts.tolist(), stops.tolist())]
+    return pd.DataFrame({'event_no': event_no[starts], 'n_pulses': stops - starts, 'pulses': blobs}, copy = False)
+
+def WriteTransforms(writer,transformer_dict,transform = 'eager'):
+    # Stores center_ and scale_ of every scaler in the transforms table (see transforms.py), so that readers can scale
+    # or unscale the stored values with numpy alone. A database holds either scaled or raw values, never both.
+    applied  = int(transform == 'eager')
+    existing = writer.read_metadata(TRANSFORMS_TABLE)
+    if existing is not None and len(existing['applied']) > 0 and existing['applied'][0] != applied:
+        raise ValueError('%s was written with --transform %s'%(writer.db_file,'eager' if existing['applied'][0] else 'lazy'))
+    rows     = [[section,column,float(transformer_dict[section][column].center_[0]),float(transformer_dict[section][column].scale_[0])] for section in transformer_dict.keys() for column in transformer_dict[section].keys()]
+    writer.write_metadata(TRANSFORMS_TABLE,{'section': np.array([row[0] for row in rows], dtype = str),
+                                            'column_name': np.array([row[1] for row in rows], dtype = str),
+                                            'center': np.array([row[2] for row in rows], dtype = np.float64),
+                                            'scale': np.array([row[3] for row in rows], dtype = np.float64),
+                                            'applied': np.full(len(rows),applied)},['section','column_name'])
+    return
+
+def WriteMetadata(writer,geo,tables,transformer_dict,layout = 'wide',precision = 'double',storage = 'rows',transform = 'eager'):
+    # Tables written once per database besides the events: the scaler parameters (table transforms), the geometry
+    # of the compact layout and, for blob storage, the dtype of the packed pulses of each features table (table blob_dtypes).
+    WriteTransforms(writer,transformer_dict,transform)
+    if layout == 'compact':
+        WriteGeometry(writer,geo,tables,AppliedTransformers(transformer_dict,transform),precision)
+    if storage == 'blob':
+        tables = list(tables)
+        writer.write_metadata('blob_dtypes',{'name': np.array([BlobTable(table) for table in tables], dtype = str),
+                                             'dtype': np.array([json.dumps(BlobDtype(layout,precision).descr)]*len(tables), dtype = str)},['name'])
+    return
+
+def SetPrecision(data,precision = 'double'):
+    # 'single' rounds the float columns to float32. SQLite stores every REAL as 8 bytes, so this does not shrink
+    # the database; it limits the precision to what a float32 reader will get anyway.
+    if precision == 'single':
+        for column in data.columns:
+            if np.issubdtype(data[column].dtype, np.floating):
+                data[column] = data[column].to_numpy().astype(np.float32)
+    return data
+
+def FeatureTables(keys):
+    # One features table per pulse series. A single key keeps the table name 'features'.
+    if len(keys) == 1:
+        return {keys[0]: 'features'}
+    return {key: 'features_' + key for key in keys}
+
+def InputSection(table):
+    # Section of transformers.pkl holding the transformers of a features table: features -> input, features_<key> -> input_<key>
+    return 'input' + table[len('features'):]
+
+def FitScalers(data,exclude):
+    scalers             = {}
+    for key in data.columns:
+        if key in exclude:
+            continue
+        print('FITTING %s TRANSFORMER' %key)
+        scaler          = RobustScaler()
+        scaler          = scaler.fit(np.array(data[key]).reshape(-1,1))
+        scalers[key]    = scaler
+    return scalers
+
+def FitTransformers(features,truth):
+    # features maps each features table to its DataFrame
+    transformer_dict    = {}
+    for table in features.keys():
+        transformer_dict[InputSection(table)] = FitScalers(features[table],['event_no'])
+    transformer_dict['truth'] = FitScalers(truth,UNSCALED_TRUTH)
+    return transformer_dict
+
+def ApplyTransformers(data,transformers):
+    # Columns that are not in data, like dom_x in the compact layout, are skipped, and so are empty chunks
+    for key in transformers.keys():
+        if key not in data.columns or len(data) == 0:
+            continue
+        data[key]       = transformers[key].transform(np.array(data[key]).reshape(-1,1))
+    return data
+
+def AppliedTransformers(transformer_dict,transform = 'eager'):
+    # The transformers applied before writing: all of them, or none with --transform lazy, where the raw values are
+    # written and the scalers are only stored in the transforms table
+    if transform == 'lazy':
+        return {section: {} for section in transformer_dict.keys()}
+    return transformer_dict
+
+def RowPriorities(rows,seed = 0):
+    # splitmix64 hash of the global row numbers. Gives every row a fixed pseudo-random priority,
+    # independent of how the rows are chunked or which worker sees them.
+    z = rows.astype(np.uint64) + np.uint64((seed + 1)*0x9E3779B97F4A7C15%2**64)
+    z = (z ^ (z >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def SketchSize(fit_error,confidence = 0.999):
+    # Number of sampled rows for which the empirical CDF is within fit_error of the true CDF everywhere,
+    # with the given confidence (Dvoretzky-Kiefer-Wolfowitz inequality). Quantiles are then off by at most fit_error in rank.
+    return int(np.ceil(np.log(2/(1 - confidence))/(2*fit_error**2)))
+
+class ColumnSketch:
+    # Mergeable uniform sample of the rows of a table. Keeps the size rows with the smallest RowPriorities,
+    # so sketching chunks separately and merging gives the same sample as sketching everything at once.
+    # If the table has no more than size rows, the sample is the table itself and the quantiles are exact.
+    # Once size rows are kept, rows with a priority above the largest kept one can never enter the sample, so update()
+    # drops them before copying their values. The remaining rows are collected in pending and only cut back to size
+    # (keep) once twice as many are waiting, so a running sketch costs about one argpartition per size rows.
+    def __init__(self,columns,size):
+        self.columns    = list(columns)
+        self.size       = size
+        self.priorities = np.empty((0,), dtype = np.uint64)
+        self.values     = np.empty((0,len(self.columns)))
+        self.threshold  = None
+        self.pending    = []
+        self.n_pending  = 0
+
+    def update(self,data,rows):
+        priorities = RowPriorities(rows)
+        selected   = slice(None) if self.threshold is None else np.flatnonzero(priorities < self.threshold)
+        values     = np.column_stack([np.asarray(data[column], dtype = np.float64)[selected] for column in self.columns]).reshape(-1, len(self.columns))
+        self.add(priorities[selected],values)
+
+    def merge(self,other):
+        other.keep()
+        self.add(other.priorities,other.values)
+
+    def add(self,priorities,values):
+        self.pending.append([priorities,values])
+        self.n_pending += len(priorities)
+        if len(self.priorities) + self.n_pending > 2*self.size:
+            self.keep()
+
+    def keep(self):
+        # Cuts the sample back to the size rows with the smallest priorities. Called before the sketch is used or sent.
+        if len(self.pending) == 0:
+            return
+        priorities = np.concatenate([self.priorities] + [pending[0] for pending in self.pending])
+        values     = np.concatenate([self.values] + [pending[1] for pending in self.pending])
+        self.pending, self.n_pending = [], 0
+        if len(priorities) > self.size:
+            keep       = np.argpartition(priorities, self.size - 1)[:self.size]
+            priorities = priorities[keep]
+            values     = values[keep]
+            self.threshold = priorities.max()
+        self.priorities = priorities
+        self.values     = values
+
+    def percentiles(self,q):
+        # one row per entry in q, one column per column in the sketch
+        self.keep()
+        return np.percentile(self.values, q, axis = 0)
+
+def SketchChunk(settings,feature_sketches,truth_sketch = None):
+    # Adds the features and truth of the events first:last to the running sketches of a fitting worker, the feature
+    # sketches by table. Sketches that do not exist yet are created. Returns the truth sketch and the number of rows.
+    # event_base and pulse_base[key] number the rows of this array after the rows of the arrays before it,
+    # so every row of every array gets its own priority when several arrays are fitted together.
+    # With a selection only the selected events are sketched, so the transformers are fitted on what is written.
+    array_path, keys, geo, first, last, size, event_base, pulse_base, selection = settings
+    pulses, truth      = OpenArrays(array_path,keys,verbose = False)
+    tables             = FeatureTables(keys)
+    selected           = None if selection is None else SelectEvents(truth[first:last],event_base + first,selection)
+    n_rows             = 0
+    for key in keys:
+        data, data_index = pulses[key]
+        if selected is None:
+            start, stop = int(data_index[first]['start']), int(data_index[last - 1]['stop'])
+            hits, rows  = data[start:stop], np.arange(start,stop)
+        else:
+            hits, hits_idx, rows = SelectPulses(data,data_index[first:last],selected)
+        features       = FeatureColumns(hits,geo)
+        if tables[key] not in feature_sketches:
+            feature_sketches[tables[key]] = ColumnSketch(features.columns,size)
+        feature_sketches[tables[key]].update(features,rows + pulse_base[key])
+        n_rows        += len(hits)
+    if selected is None:
+        truth_chunk    = ExtractTruth(truth[first:last],event_offset = first)
+        rows           = np.arange(first,last)
+    else:
+        truth_chunk    = ExtractTruth(truth[first:last][selected],event_no = first + 1 + selected)
+        rows           = first + selected
+    if truth_sketch is None:
+        truth_sketch   = ColumnSketch([column for column in truth_chunk.columns if column not in UNSCALED_TRUTH],size)
+    truth_sketch.update(truth_chunk,rows + event_base)
+    n_rows            += len(truth_chunk)
+    return truth_sketch, n_rows
+
+def SketchChunks(group):
+    # Runs in the fitting Pool. Keeps one running sketch per table over all chunks of the group (settings of SketchChunk)
+    # and returns only those, so the parent merges one sketch per worker and not one per chunk.
+    start_time         = time.time()
+    feature_sketches   = {}
+    truth_sketch       = None
+    n_rows             = 0
+    for settings in group:
+        truth_sketch, rows = SketchChunk(settings,feature_sketches,truth_sketch)
+        n_rows        += rows
+    for sketch in list(feature_sketches.values()) + [truth_sketch]:
+        sketch.keep()
+    return feature_sketches, truth_sketch, WorkerStats('fit',start_time,n_rows)
+
+def SketchScalers(sketch):
+    # RobustScalers with the same center_ and scale_ a RobustScaler().fit() on each column would get
+    scalers     = {}
+    q25, q50, q75 = sketch.percentiles([25,50,75])
+    for j in range(len(sketch.columns)):
+        scaler                = RobustScaler()
+        scaler.center_        = np.array([q50[j]])
+        scaler.scale_         = np.array([q75[j] - q25[j] if q75[j] != q25[j] else 1.0])
+        scaler.n_features_in_ = 1
+        scalers[sketch.columns[j]] = scaler
+    return scalers
+
+def SketchTransformers(array_path,keys,geo,data_index,df_size,n_workers,fit_error = 0.002,metrics = None,selection = None):
+    # Fits the transformers from mergeable column sketches. The event-aligned chunks are sketched in parallel, each worker
+    # keeping one running sketch, so memory stays bounded by the sketch size, df_size and n_workers.
+    size     = SketchSize(fit_error)
+    settings = [[array_path,keys,geo,first,last,size,0,{key: 0 for key in keys},selection] for first, last in EventChunks(data_index,df_size)]
+    return FitSketches(settings,n_workers,size,metrics)
+
+def SketchRuns(array_paths,keys,geo,df_size,n_workers,fit_error = 0.002,metrics = None,selection = None):
+    # SketchTransformers over several i3cols directories at once, as if they were one array.
+    # Returns the transformers and the number of events in each directory.
+    size       = SketchSize(fit_error)
+    settings   = []
+    n_events   = []
+    event_base = 0
+    pulse_base = {key: 0 for key in keys}
+    for array_path in array_paths:
+        pulses, truth = OpenArrays(array_path,keys,verbose = False)
+        data_index    = pulses[keys[0]][1]
+        if len(data_index) > 0:
+            for first, last in EventChunks(data_index,df_size):
+                settings.append([array_path,keys,geo,first,last,size,event_base,dict(pulse_base),selection])
+        n_events.append(len(truth))
+        event_base   += len(truth)
+        for key in keys:
+            pulse_base[key] += len(pulses[key][0])
+    return FitSketches(settings,n_workers,size,metrics), n_events
+
+def FitSketches(settings,n_workers,size,metrics = None):
+    # Sketches the chunks described by settings (see SketchChunk) in parallel and fits the transformers from the merged sketches.
+    # The chunks are dealt out as n_workers consecutive groups, each sketched by one worker (SketchChunks).
+    print('SKETCHING TRANSFORMERS ON %s CHUNKS (AT MOST %s ROWS PER TABLE)'%(len(settings),size))
+    if metrics is None:
+        metrics = Metrics()
+    groups   = [[settings[j] for j in group] for group in np.array_split(np.arange(len(settings)),max(1,min(n_workers,len(settings)))) if len(group) > 0]
+    feature_sketches, truth_sketch = None, None
+    with metrics.stage('fit') as stage:
+        p = Pool(processes = n_workers)
+        for chunk_features, chunk_truth, stats in p.imap_unordered(SketchChunks, groups):
+            if truth_sketch is None:
+                feature_sketches, truth_sketch = chunk_features, chunk_truth
+            else:
+                for table in feature_sketches.keys():
+                    feature_sketches[table].merge(chunk_features[table])
+                truth_sketch.merge(chunk_truth)
+            metrics.add_worker(stats)
+            stage.rows += stats['rows']
+        p.close()
+        p.join()
+    if truth_sketch is not None:
+        for sketch in list(feature_sketches.values()) + [truth_sketch]:
+            sketch.keep()
+    if truth_sketch is None or len(truth_sketch.values) == 0:
+        raise ValueError('No events to fit the transformers on. Does the selection keep any events?')
+    transformer_dict = {}
+    for table in feature_sketches.keys():
+        print('FITTING %s TRANSFORMERS ON %s PULSES'%(table,len(feature_sketches[table].values)))
+        transformer_dict[InputSection(table)] = SketchScalers(feature_sketches[table])
+    print('FITTING truth TRANSFORMERS ON %s EVENTS'%len(truth_sketch.values))
+    transformer_dict['truth'] = SketchScalers(truth_sketch)
+    return transformer_dict
+
+def MakeOutputDirectories(outdir,db_name,exist_ok = False):
+    transformer_path = outdir + '/' + '/%s/'%db_name + 'meta'
+    db_path          = outdir + '/' + '/%s/'%db_name + 'data'
+    os.makedirs(db_path, exist_ok = exist_ok)
+    os.makedirs(transformer_path, exist_ok = exist_ok)
+    return db_path, transformer_path
+
+def PrepareOutput(array_path,db_name,keys,geo,outdir,data_index,df_size,n_workers,fit_error,append = False,metrics = None,selection = None):
+    # Creates the output directories and fits and saves the transformers. When appending to an existing database
+    # its transformers.pkl is reused instead, so old and new events are scaled the same way.
+    transformer_path = outdir + '/' + '/%s/'%db_name + 'meta'
+    if append and os.path.isfile(transformer_path + '/transformers.pkl'):
+        print('APPENDING TO %s, REUSING ITS TRANSFORMERS'%db_name)
+        db_path, transformer_path = MakeOutputDirectories(outdir,db_name,exist_ok = True)
+        return db_path + '/%s.db'%db_name, pd.read_pickle(transformer_path + '/transformers.pkl')
+    if len(data_index) == 0:
+        raise ValueError('%s holds no events to fit the transformers on'%array_path)
+    transformer_dict      = SketchTransformers(array_path,keys,geo,data_index,df_size,n_workers,fit_error,metrics,selection)
+    db_path, transformer_path = MakeOutputDirectories(outdir,db_name,exist_ok = append)
+    SaveTransformers(transformer_dict,transformer_path)
+    return db_path + '/%s.db'%db_name, transformer_dict
+
+def OutputSettings(keys,layout = 'wide',schema = 'plain',storage = 'rows',precision = 'double',aggregate = False):
+    # Options that decide which tables a database has and what their rows hold. Every source of a database
+    # has to be converted with the same ones (see RegisterSettings).
+    return {'key': list(keys), 'layout': layout, 'schema': schema, 'storage': storage, 'precision': precision, 'aggregate': bool(aggregate)}
+
+def RegisterSettings(con,settings):
+    # Records settings (see OutputSettings) in the manifest when the database is created, and raises if a later append
+    # or resume uses different ones. Settings missing from the manifest, e.g. of databases written before it held them, are added.
+    con.execute('CREATE TABLE IF NOT EXISTS manifest_settings (name TEXT PRIMARY KEY, value TEXT)')
+    recorded = dict(con.execute('SELECT name, value FROM manifest_settings').fetchall())
+    for name in settings.keys():
+        value = json.dumps(settings[name])
+        if name not in recorded:
+            con.execute('INSERT INTO manifest_settings VALUES (?,?)', (name,value))
+        elif recorded[name] != value:
+            raise ValueError('The database was written %s and cannot be appended to %s'%(SettingFlag(name,json.loads(recorded[name])),SettingFlag(name,settings[name])))
+    return
+
+def SettingFlag(name,value):
+    # 'with --layout compact', 'with --key A B', 'without --aggregate'
+    if isinstance(value, bool):
+        return ('with --%s' if value else 'without --%s')%name
+    return 'with --%s %s'%(name,' '.join(map(str,value)) if isinstance(value, list) else value)
+
+def RegisterSource(con,source,n_events,event_offset = None):
+    # Returns the event_no offset of source. A source seen before keeps its offset, so a resumed run
+    # numbers its events as the interrupted run did. A new source gets the range after everything in the database,
+    # unless event_offset is given (for sources whose events are already in the database).
+    con.execute('CREATE TABLE IF NOT EXISTS manifest_sources (source TEXT PRIMARY KEY, event_offset INTEGER, n_events INTEGER)')
+    con.execute('CREATE TABLE IF NOT EXISTS manifest_chunks (source TEXT, first_event INTEGER, last_event INTEGER, committed_at REAL)')
+    row = con.execute('SELECT event_offset, n_events FROM manifest_sources WHERE source = ?', (source,)).fetchone()
+    if row is not None:
+        if row[1] != n_events:
+            raise ValueError('%s holds %s events, but the manifest recorded %s'%(source,n_events,row[1]))
+        return row[0]
+    if event_offset is not None:
+        con.execute('INSERT INTO manifest_sources VALUES (?,?,?)', (source,int(event_offset),n_events))
+        return int(event_offset)
+    event_offset = con.execute('SELECT MAX(event_offset + n_events) FROM manifest_sources').fetchone()[0]
+    if len(TableColumns(con,'truth')) > 0:
+        # databases written before the manifest existed, or in batch mode
+        event_offset = max(event_offset or 0, con.execute('SELECT MAX(event_no) FROM truth').fetchone()[0] or 0)
+    event_offset = int(event_offset or 0)
+    con.execute('INSERT INTO manifest_sources VALUES (?,?,?)', (source,event_offset,n_events))
+    return event_offset
+
+def CommittedChunks(con,source):
+    return [[row[0], row[1]] for row in con.execute('SELECT first_event, last_event FROM manifest_chunks WHERE source = ? ORDER BY first_event', (source,))]
+
+def RemainingChunks(data_index,df_size,committed):
+    # Event-aligned chunks covering the events of data_index that are not in any committed [first, last) range
+    chunks   = []
+    position = 0
+    for first, last in sorted(committed) + [[len(data_index), len(data_index)]]:
+        if first > position:
+            for start, stop in EventChunks(data_index[position:first],df_size):
+                chunks.append([position + start, position + stop])
+        position = max(position,last)
+    return chunks
+
+def SaveTransformers(transformer_dict,transformer_path):
+    print('SAVING TRANSFORMERS..')
+    tmp = open(transformer_path + '/transformers.pkl', 'wb')
+    pickle.dump(transformer_dict, tmp)
+    tmp.close()
+    return
+
+def OpenArrays(array_path,keys,verbose = True):
+    # Memory-maps the pulse array and index of every key, and the truth array. Nothing is read until it is sliced.
+    # Returns {key: [data, data_index]} and the truth array.
+    truth_key             = 'MCInIcePrimary'
+    if verbose:
+        print('MEMORY-MAPPING %s TRUTH ARRAY'%truth_key)
+    truth                 = np.load(array_path + '/' + truth_key + '/data.npy', mmap_mode = 'r')
+    pulses                = {}
+    for key in keys:
+        path              = array_path + '/' + key
+        if verbose:
+            print('MEMORY-MAPPING %s FEATURE ARRAY...'%key)
+        data              = np.load(path + '/data.npy', mmap_mode = 'r')
+        data_index        = np.load(path + '/index.npy', mmap_mode = 'r')
+        if len(data_index) != len(truth):
+            raise ValueError('%s has %s events, but %s has %s'%(key,len(data_index),truth_key,len(truth)))
+        pulses[key]       = [data, data_index]
+    return pulses, truth
+
+def ConvertChunk(pulses,truth,geo,transformer_dict,first,last,schema = 'plain',event_base = 0,layout = 'wide',precision = 'double',storage = 'rows',aggregate = False,selection = None):
+    # Extracts and transforms the events first:last. Returns the truth DataFrame and {table: features DataFrame}.
+    # event_base is added to all event numbers, e.g. when appending to a database that already holds events.
+    # With a selection (see ParseSelection) only the events passing it are converted, and only their pulses are read.
+    # They keep the event_no they have without a selection.
+    tables            = FeatureTables(list(pulses.keys()))
+    features          = {}
+    selected          = None
+    event_no          = None
+    if selection is not None:
+        selected      = SelectEvents(truth[first:last],event_base + first,selection)
+        event_no      = event_base + first + 1 + selected
+    for key in pulses.keys():
+        data, data_index = pulses[key]
+        chunk_index   = data_index[first:last]
+        if selected is None:
+            hits      = data[int(chunk_index[0]['start']):int(chunk_index[-1]['stop'])]
+        else:
+            hits, chunk_index, rows = SelectPulses(data,chunk_index,selected)
+        table         = tables[key]
+        if aggregate:
+            features[DomTable(table)] = SetPrecision(ApplyTransformers(DomSummary(hits,chunk_index,geo,event_base + first,layout,event_no), transformer_dict[InputSection(table)]),precision)
+        features[table] = ExtractFeatures(hits,chunk_index,geo,event_offset = event_base + first,event_no = event_no)
+        if layout == 'compact':
+            features[table] = CompactFeatures(features[table],DomIds(hits,geo))
+        features[table] = SetPrecision(ApplyTransformers(features[table], transformer_dict[InputSection(table)]),precision)
+        if storage == 'blob':
+            features[BlobTable(table)] = PackEvents(features.pop(table),BlobDtype(layout,precision))
+        elif schema == 'indexed':
+            features[table] = AddPulseIndex(features[table])
+    truth_chunk       = truth[first:last] if selected is None else truth[first:last][selected]
+    truth_chunk       = SetPrecision(ApplyTransformers(ExtractTruth(truth_chunk,event_offset = event_base + first,event_no = event_no), transformer_dict['truth']),precision)
+    return truth_chunk, features
+
+def StreamDataBase(array_path,db_name,keys,gcd_path,outdir,df_size,pragmas = None,schema = 'plain',n_workers = 1,fit_error = 0.002,append = False,metrics = None,layout = 'wide',precision = 'double',storage = 'rows',aggregate = False,selection = None,transform = 'eager',backend = 'sqlite'):
+    #
+    # STREAMING
+    # The arrays are memory-mapped and walked in event-aligned chunks of roughly df_size pulses (counted in the first key).
+    # Each chunk is transformed and written to the database before the next one is read,
+    # so peak memory follows df_size and not the size of the dataset.
+    # backend is a key of OUTPUT_BACKENDS. Every chunk becomes a transaction in SQLite and a row group in Parquet.
+    #
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.stage('load'):
+        pulses, truth     = OpenArrays(array_path,keys)
+        data_index        = pulses[keys[0]][1]
+        geo               = GrabGCD(gcd_path)
+
+    db_file, transformer_dict = PrepareOutput(array_path,db_name,keys,geo,outdir,data_index,df_size,n_workers,fit_error,append,metrics,selection)
+
+    writer                = OpenWriter(db_file,backend,pragmas,schema)
+    db_file               = writer.db_file
+    writer.register_settings(OutputSettings(keys,layout,schema,storage,precision,aggregate))
+    source                = os.path.abspath(array_path)
+    event_base            = writer.register_source(source,len(data_index))
+    chunks                = RemainingChunks(data_index,df_size,writer.committed_chunks(source))
+    WriteMetadata(writer,geo,FeatureTables(keys).values(),transformer_dict,layout,precision,storage,transform)
+    writer.commit()
+    n_rows                = 0
+    for j in range(len(chunks)):
+        first, last       = chunks[j]
+        with metrics.stage('convert') as stage:
+            truth_chunk, features = ConvertChunk(pulses,truth,geo,AppliedTransformers(transformer_dict,transform),first,last,schema,event_base,layout,precision,storage,aggregate,selection)
+            stage.rows    = len(truth_chunk) + sum([len(features[table]) for table in features.keys()])
+        with metrics.stage('write') as stage:
+            size          = FileSize(db_file)
+            writer.write('truth',truth_chunk)
+            for table in features.keys():
+                writer.write(table,features[table])
+            writer.commit_chunk(source,first,last)
+            stage.rows    = len(truth_chunk) + sum([len(features[table]) for table in features.keys()])
+            stage.bytes_written = FileSize(db_file) - size
+        n_rows           += stage.rows
+        if not metrics.progress(j+1,len(chunks),n_rows):
+            print('INSERTING CHUNK %s / %s (%s events)'%(j+1,len(chunks),len(truth_chunk)))
+    with metrics.stage('index'):
+        writer.finish()
+    return
+
+def ConvertWorker(array_path,keys,geo,transformer_dict,tasks,results,schema = 'plain',event_base = 0,layout = 'wide',precision = 'double',storage = 'rows',aggregate = False,selection = None,gate = None):
+    # Producer in pipeline mode. Takes [first, last] event ranges from tasks until it gets None,
+    # and puts the converted columns on the bounded results queue. None on results means this worker is done.
+    # With a memory budget the writer closes gate (a multiprocessing.Event) while memory is short; chunks are only started while it is open.
+    try:
+        pulses, truth = OpenArrays(array_path,keys,verbose = False)
+        chunk = tasks.get()
+        while chunk is not None:
+            if gate is not None:
+                gate.wait()
+            first, last = chunk
+            start_time  = time.time()
+            truth_chunk, features = ConvertChunk(pulses,truth,geo,transformer_dict,first,last,schema,event_base,layout,precision,storage,aggregate,selection)
+            n_rows      = len(truth_chunk) + sum([len(features[table]) for table in features.keys()])
+            results.put([first, last,
+                         {column: truth_chunk[column].to_numpy() for column in truth_chunk.columns},
+                         {table: {column: features[table][column].to_numpy() for column in features[table].columns} for table in features.keys()},
+                         WorkerStats('convert',start_time,n_rows)])
+            chunk = tasks.get()
+    except Exception:
+        results.put(traceback.format_exc())
+        return
+    results.put(None)
+    return
+
+def PipelineDataBase(array_path,db_name,keys,gcd_path,outdir,n_workers,df_size,pragmas = None,schema = 'plain',fit_error = 0.002,append = False,metrics = None,layout = 'wide',precision = 'double',storage = 'rows',aggregate = False,selection = None,transform = 'eager',memory_budget = None,backend = 'sqlite'):
+    #
+    # PIPELINE
+    # n_workers producer processes convert event-aligned chunks in parallel, while this process is the
+    # only writer and inserts the chunks straight into the final database as they arrive.
+    # The results queue is bounded, so producers wait when the writer falls behind.
+    # With a memory_budget (bytes) they also wait while all processes together come close to it (see Throttle).
+    # No temporary databases are written and nothing has to be merged. backend is as in StreamDataBase.
+    #
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.stage('load'):
+        pulses, truth     = OpenArrays(array_path,keys)
+        data_index        = pulses[keys[0]][1]
+        geo               = GrabGCD(gcd_path)
+
+    db_file, transformer_dict = PrepareOutput(array_path,db_name,keys,geo,outdir,data_index,df_size,n_workers,fit_error,append,metrics,selection)
+
+    writer                = OpenWriter(db_file,backend,pragmas,schema)
+    db_file               = writer.db_file
+    writer.register_settings(OutputSettings(keys,layout,schema,storage,precision,aggregate))
+    source                = os.path.abspath(array_path)
+    event_base            = writer.register_source(source,len(data_index))
+    chunks                = RemainingChunks(data_index,df_size,writer.committed_chunks(source))
+    WriteMetadata(writer,geo,FeatureTables(keys).values(),transformer_dict,layout,precision,storage,transform)
+    writer.commit()
+    del pulses, data_index, truth
+    tasks                 = multiprocessing.Queue()
+    results               = multiprocessing.Queue(maxsize = 2*n_workers)
+    for chunk in chunks:
+        tasks.put(chunk)
+    for j in range(n_workers):
+        tasks.put(None)
+    gate                  = None
+    if memory_budget is not None:
+        gate              = multiprocessing.Event()
+        gate.set()
+
+    workers = []
+    for j in range(n_workers):
+        worker = multiprocessing.Process(target = ConvertWorker, args = (array_path,keys,geo,AppliedTransformers(transformer_dict,transform),tasks,results,schema,event_base,layout,precision,storage,aggregate,selection,gate))
+        worker.start()
+        workers.append(worker)
+
+    n_done                = 0
+    n_written             = 0
+    n_rows                = 0
+    try:
+        while n_done < n_workers:
+            try:
+                with metrics.stage('wait'):   # time the writer spends waiting for the producers
+                    result = results.get(timeout = 10)
+            except queue.Empty:
+                if WorkForeman(workers) == False:
+                    raise RuntimeError('All conversion workers stopped before finishing')
+                continue
+            if result is None:
+                n_done += 1
+                continue
+            if isinstance(result, str):
+                raise RuntimeError('A conversion worker failed:\n%s'%result)
+            first, last, truth_chunk, features, stats = result
+            metrics.add_worker(stats)
+            with metrics.stage('write') as stage:
+                size      = FileSize(db_file)
+                writer.write('truth',truth_chunk)
+                for table in features.keys():
+                    writer.write(table,features[table])
+                writer.commit_chunk(source,first,last)
+                stage.rows = stats['rows']
+                stage.bytes_written = FileSize(db_file) - size
+            n_written += 1
+            n_rows    += stats['rows']
+            if gate is not None and Throttle(gate,workers,memory_budget,results):
+                metrics.info['throttled'] = metrics.info.get('throttled', 0) + 1
+                print('MEMORY BUDGET NEARLY USED, PRODUCERS WAIT UNTIL THE QUEUED CHUNKS ARE WRITTEN')
+            if not metrics.progress(n_written,len(chunks),n_rows):
+                print('INSERTING CHUNK %s / %s (%s events)'%(n_written,len(chunks),len(truth_chunk['event_no'])))
+            del truth_chunk, features, result
+    finally:
+        for worker in workers:
+            if worker.is_alive() and n_done < n_workers:
+                worker.terminate()
+            worker.join()
+    with metrics.stage('index'):
+        writer.finish()
+    return
+
+def ShardWorker(settings):
+    # Sharded mode: converts the events first:last into their own database in event-aligned chunks of roughly df_size pulses.
+    # event_base is added to the event numbers, as in ConvertChunk.
+    array_path, keys, geo, transformer_dict, shard_file, first, last, df_size, pragmas, schema, layout, precision, storage, event_base, aggregate, selection, transform = settings
+    start_time            = time.time()
+    pulses, truth         = OpenArrays(array_path,keys,verbose = False)
+    data_index            = pulses[keys[0]][1]
+    writer                = SQLiteWriter(shard_file,pragmas,transaction_size = None,schema = schema)
+    WriteMetadata(writer,geo,FeatureTables(keys).values(),transformer_dict,layout,precision,storage,transform)
+    n_rows                = 0
+    for start, stop in EventChunks(data_index[first:last],df_size):
+        truth_chunk, features = ConvertChunk(pulses,truth,geo,AppliedTransformers(transformer_dict,transform),first + start,first + stop,schema,event_base,layout,precision,storage,aggregate,selection)
+        writer.write('truth',truth_chunk)
+        for table in features.keys():
+            writer.write(table,features[table])
+        writer.commit()
+        n_rows           += len(truth_chunk) + sum([len(features[table]) for table in features.keys()])
+    writer.finish()
+    return shard_file, first, last, WorkerStats('shard',start_time,n_rows,FileSize(shard_file))
+
+def WriteCatalog(catalog_file,shards,tables,schema,selected = False):
+    # shards is a list of [shard_file, first, last]. The catalog maps the event_no range of every shard,
+    # first + 1 to last inclusive, to its file. Files are stored relative to the catalog.
+    # selected records that only some of the events in these ranges were written.
+    catalog = {'tables': tables,
+               'schema': schema,
+               'selected': selected,
+               'shards': [{'file': os.path.basename(shard_file),
+                           'first_event_no': first + 1,
+                           'last_event_no': last,
+                           'n_events': last - first} for shard_file, first, last in sorted(shards, key = lambda shard: shard[1])]}
+    with open(catalog_file, 'w') as tmp:
+        json.dump(catalog, tmp, indent = 1)
+    return
+
+def ShardDataBase(array_path,db_name,keys,gcd_path,outdir,n_workers,df_size,pragmas = None,schema = 'plain',fit_error = 0.002,metrics = None,layout = 'wide',precision = 'double',storage = 'rows',aggregate = False,selection = None,transform = 'eager'):
+    #
+    # SHARDED
+    # The events are cut into n_workers consecutive ranges of about the same number of pulses, and each worker
+    # converts its range straight into its own shard database. Nothing is merged. <db_name>_catalog.json maps
+    # event_no ranges to the shards and is read by shard_router.ShardRouter.
+    #
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.stage('load'):
+        pulses, truth     = OpenArrays(array_path,keys)
+        data_index        = pulses[keys[0]][1]
+        geo               = GrabGCD(gcd_path)
+
+    db_file, transformer_dict = PrepareOutput(array_path,db_name,keys,geo,outdir,data_index,df_size,n_workers,fit_error,metrics = metrics,selection = selection)
+    db_path               = os.path.dirname(db_file)
+    n_pulses              = int(data_index['stop'][-1]) - int(data_index['start'][0]) if len(data_index) > 0 else 0
+    ranges                = EventChunks(data_index,max(1,int(np.ceil(n_pulses/n_workers))))
+    del pulses, data_index, truth
+    settings              = []
+    for j in range(len(ranges)):
+        shard_file        = db_path + '/%s_shard%s.db'%(db_name,j)
+        settings.append([array_path,keys,geo,transformer_dict,shard_file,ranges[j][0],ranges[j][1],df_size,pragmas,schema,layout,precision,storage,0,aggregate,selection,transform])
+
+    shards                = []
+    n_rows                = 0
+    with metrics.stage('write') as stage:
+        p = Pool(processes = n_workers)
+        for shard_file, first, last, stats in p.imap_unordered(ShardWorker, settings):
+            metrics.add_worker(stats)
+            shards.append([shard_file, first, last])
+            n_rows       += stats['rows']
+            stage.rows   += stats['rows']
+            stage.bytes_written += stats['bytes_written']
+            if not metrics.progress(len(shards),len(settings),n_rows):
+                print('WROTE SHARD %s / %s (events %s to %s)'%(len(shards),len(settings),first + 1,last))
+        p.close()
+        p.join()
+    WriteCatalog(db_path + '/%s_catalog.json'%db_name,shards,['truth'] + OutputTables(keys,storage,aggregate),schema,selection is not None)
+    return
+
+def WriteTemporaries(data_tables,db_path,n_workers,df_size,pragmas = None,schema = 'plain',transport = 'queue',metrics = None):
+    # Batch mode write. data_tables maps table names to DataFrames, 'truth' first. The dict is emptied once
+    # its rows have been handed to the workers, so the DataFrames can be freed while the workers write.
+    if metrics is None:
+        metrics = Metrics()
+    
+    # 
+    #  INITIAL COMMITS
+    #  Creates and commits 11 rows of data in each table in the main SQLite DataBase 
+    #
+
+    with metrics.stage('initial commit') as stage:
+        writer = SQLiteWriter(db_path,pragmas,schema = schema)
+        for table in data_tables.keys():
+            print('MAKING INITIAL %s COMMIT'%table)
+            writer.write(table,data_tables[table].loc[0:10,:])
+            stage.rows += len(data_tables[table].loc[0:10,:])
+        writer.close()
+        stage.bytes_written = FileSize(db_path)
+    
+    #
+    #  MULTI-PROCESSING 
+    # 'FillStack' provides a multiprocessing.Queue() full of pd.DataFrames() with df_size rows for each worker.  
+    #  Each worker then fills a temporary database with these pd.DataFrames() using SQLiteWriter
+    #  With transport = 'shm' the columns are instead placed once in shared memory and each worker
+    #  only receives the row range it should write (FillSharedStack / WriteSharedToDB)
+    #
+    blocks            = []
+    settings          = {}
+    with metrics.stage('stack') as stage:
+        if transport == 'shm':
+            for table in data_tables.keys():
+                blocks_table, columns_table = ShareColumns(data_tables[table])
+                blocks       += blocks_table
+                settings[table] = FillSharedStack(n_workers, data_tables[table], columns_table, df_size, table, db_path, pragmas)
+            writer_function   = WriteSharedToDB
+        else:
+            manager = multiprocessing.Manager()
+            for table in data_tables.keys():
+                settings[table] = FillStack(n_workers, data_tables[table], df_size, manager, table, db_path, pragmas) # Arguments for FillStack
+            writer_function   = WriteToDB
+        stage.rows = sum([len(data_tables[table]) for table in data_tables.keys()])
+    data_tables.clear()   # The data is now stored in chunks in multiprocessing.Queue()'s via FillStack() or in shared memory, so it's fine
+    
+    try:
+        with metrics.stage('write') as stage:
+            p = Pool(processes = n_workers)
+            n_done      = 0
+            n_jobs      = sum([len(settings[table]) for table in settings.keys()])
+            for table in settings.keys():
+                for stats in p.imap_unordered(writer_function, settings[table]):   # This fills the rest of each table using n_workers, one table after the other
+                    metrics.add_worker(stats)
+                    stage.rows          += stats['rows']
+                    stage.bytes_written += stats['bytes_written']
+                    n_done      += 1
+                    metrics.progress(n_done,n_jobs,stage.rows)
+            p.close()
+            p.join()
+    finally:
+        ReleaseColumns(blocks, unlink = True)
+    return
+
+def MergeTemporaryDataBases(path,tables,delete_temporaries = False,pragmas = None,schema = 'plain',metrics = None):
+    #
+    # MERGING
+    # Here the temporary databases in path are attached to the main database one at a time and copied over inside SQLite
+    # 
+    if metrics is None:
+        metrics = Metrics()
+    main_db, tmp = MergeTemporaries(path)
+    with metrics.stage('merge') as stage:
+        size = FileSize(path + '/' + main_db)
+        MergeShards(path + '/' + main_db, [path + '/' + shard for shard in sorted(tmp)], tables, delete_temporaries, pragmas, schema, metrics.progress)
+        stage.bytes_written = FileSize(path + '/' + main_db) - size
+    with metrics.stage('index'):
+        BuildIndices(path + '/' + main_db, schema)
+    return
+
+def ParsePragmas(pragmas):
+    # ['journal_mode=WAL', 'synchronous=NORMAL'] -> {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
+    if pragmas is None or isinstance(pragmas, dict):
+        return pragmas
+    parsed = {}
+    for pragma in pragmas:
+        name, value   = pragma.split('=',1)
+        parsed[name.strip()] = value.strip()
+    return parsed
+
 def parse_args(description=__doc__):
     """Parse command line args"""
     parser = ArgumentParser(
@@ -113,8 +1545,8 @@ def parse_args(description=__doc__):
         help='The path in which the data.npy and index.npy is saved. E.g: /home/my_awesome_arrays/SplitInIcePulses',
     )
     parser.add_argument(
-        '--key', type=str, required=True,
-        help='The key for the array containing the pulse data you want in the database. e.g. SplitInIcePulses ',
+        '--key', type=str, required=True, nargs='+',
+        help='The key(s) for the array(s) containing the pulse data you want in the database. e.g. SplitInIcePulses. With several keys each gets its own features_<key> table, sharing truth and event_no',
     )
     parser.add_argument(
         '--db_name', type=str, required=True,
@@ -123,7 +1555,7 @@ def parse_args(description=__doc__):
     parser.add_argument(
         '--gcd_path', metavar='GCD_PATH', dest='gcd_path', type=str,
         required=True,
-        help='The Path to the GCD.pkl file. Just provide the path not the actual file. E.g: /home/gcd not /home/gcd/gcd.pkl - the code will search for any .pkl file in the directory - so keep it tight. Having multiple will make the code fail. '
+        help='The Path to the GCD.pkl file. Just provide the path not the actual file. E.g: /home/gcd not /home/gcd/gcd.pkl - the code will search for any .pkl file in the directory - so keep it tight. Having multiple will make the code fail. Can also be an entry of the geometry cache of i3ToNumpy/create_geo_array.py, e.g. /home/gcd_cache/<md5 of the GCD .i3 file>, which is memory-mapped instead'
     )
     parser.add_argument(
         '--outdir', type=str, required=True,
@@ -133,8 +1565,90 @@ def parse_args(description=__doc__):
         '--n_workers', type=int, required=True,
         help='Number of Workers',
     )
+    parser.add_argument(
+        '--mode', type=str, default='batch', choices=['batch', 'streaming', 'pipeline', 'sharded'],
+        help='batch loads the full arrays into memory and writes them with n_workers. streaming memory-maps the arrays and converts them chunk by chunk, so memory usage is bounded by df_size. pipeline does the same conversion in n_workers processes and writes the chunks from a single writer. sharded writes n_workers event-range shard databases in parallel plus a catalog, without merging them',
+    )
+    parser.add_argument(
+        '--df_size', type=int, default=100000,
+        help='Number of rows in each commit. In streaming mode this is the approximate number of pulses held in memory at once',
+    )
+    parser.add_argument(
+        '--pragmas', type=str, nargs='*', default=None,
+        help='SQLite PRAGMAs used during the bulk load, overriding the defaults in BULK_PRAGMAS. E.g: journal_mode=WAL synchronous=NORMAL page_size=4096 cache_size=-200000',
+    )
+    parser.add_argument(
+        '--delete_temporaries', action='store_true',
+        help='Delete each temporary _tmp-N.db database once it has been merged into the main database',
+    )
+    parser.add_argument(
+        '--transport', type=str, default='queue', choices=['queue', 'shm'],
+        help='How batch mode hands the data to the workers. queue pickles DataFrame chunks through a multiprocessing.Manager().Queue(). shm places the columns once in shared memory and only sends row offsets',
+    )
+    parser.add_argument(
+        '--schema', type=str, default='plain', choices=['plain', 'indexed'],
+        help='plain writes heap tables without keys. indexed keys truth by an INTEGER PRIMARY KEY event_no and clusters features by (event_no, pulse_idx) in a WITHOUT ROWID table, for fast event_no lookups',
+    )
+    parser.add_argument(
+        '--fit_error', type=float, default=0.002,
+        help='Streaming and pipeline mode fit the transformers on a mergeable sample of each table. This is the largest allowed rank error of the fitted quantiles (at 99.9%% confidence); smaller values sample more rows. Tables that fit in the sample are fitted exactly',
+    )
+    parser.add_argument(
+        '--append', action='store_true',
+        help='Streaming and pipeline mode: write into an existing database instead of failing. Arrays already recorded in its manifest resume from their last committed chunk; new arrays are appended with event_no continuing after the existing events',
+    )
+    parser.add_argument(
+        '--layout', type=str, default='wide', choices=['wide', 'compact'],
+        help='wide stores dom_x, dom_y and dom_z with every pulse. compact stores an integer event_no and dom_id per pulse instead, and the DOM positions once in a geometry table',
+    )
+    parser.add_argument(
+        '--precision', type=str, default='double', choices=['double', 'single'],
+        help='single rounds all float columns to float32 before they are written',
+    )
+    parser.add_argument(
+        '--storage', type=str, default='rows', choices=['rows', 'blob'],
+        help='rows writes one row per pulse. blob writes the pulses of each event as one packed buffer in features_blob, keyed by event_no (streaming, pipeline and sharded mode)',
+    )
+    parser.add_argument(
+        '--aggregate', action='store_true',
+        help='Also write doms, a table with one row per hit DOM and event: first_time, total_charge and n_hits of its pulses',
+    )
+    parser.add_argument(
+        '--progress', action='store_true',
+        help='Show a live progress line (chunks, rows, rows/sec, peak RSS) on stderr instead of one line per chunk. In batch mode it follows the temporary databases as they are written and merged',
+    )
+    parser.add_argument(
+        '--metrics_path', type=str, default=None,
+        help='Where to write the JSON report of wall time, rows, rows/sec, bytes written and peak RSS per stage and per worker. Defaults to outdir/db_name/meta/metrics.json',
+    )
+    parser.add_argument(
+        '--transform', type=str, default='eager', choices=['eager', 'lazy'],
+        help='eager writes values scaled by the fitted RobustScalers. lazy writes the raw values, and readers scale them with the centers and scales stored in the transforms table (see transforms.py), so a new scaling needs no new database. Both store the scalers in the transforms table',
+    )
+    parser.add_argument(
+        '--select', type=str, nargs='+', default=None,
+        help='Only convert the events whose MCInIcePrimary fields pass all of these predicates, e.g. "energy>10" "pdg_encoding in 14,-14" "dir.zenith<1.5". Operators: == != < <= > >= in. Events keep the event_no they would have without a selection',
+    )
+    parser.add_argument(
+        '--subsample', type=float, default=None,
+        help='Keep this fraction of the (selected) events, chosen by a hash of event_no, so the same events are kept in every mode and run',
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed of --subsample',
+    )
+    parser.add_argument(
+        '--memory_budget', '--memory-budget', type=str, default=None,
+        help='Memory all processes together may use, e.g. 16G or 500M. df_size and n_workers are then chosen to fit it '
+             '(n_workers becomes the largest number of workers), and pipeline producers wait while it is nearly used',
+    )
+    parser.add_argument(
+        '--backend', type=str, default='sqlite', choices=['sqlite', 'parquet'],
+        help='Output format of streaming and pipeline mode. parquet writes outdir/db_name/data/db_name.parquet/<table>.parquet '
+             'with one row group per chunk (needs pyarrow)',
+    )
     return parser.parse_args()
-def CreateDataBase(array_path,db_name,key,gcd_path,outdir,n_workers):
+def CreateDataBase(array_path,db_name,key,gcd_path,outdir,n_workers,mode = 'batch',df_size = 100000,pragmas = None,delete_temporaries = False,transport = 'queue',schema = 'plain',fit_error = 0.002,append = False,progress = False,metrics_path = None,layout = 'wide',precision = 'double',storage = 'rows',aggregate = False,select = None,subsample = None,seed = 0,transform = 'eager',memory_budget = None,backend = 'sqlite'):
     #array_path            = r'X:\speciale\hep\arrays_from_hep\arrays'
     #gcd_path              = r'X:\speciale\hep\gcd\gcd_array'
     #key                   = 'SplitInIcePulses'
@@ -142,19 +1656,74 @@ def CreateDataBase(array_path,db_name,key,gcd_path,outdir,n_workers):
     #db_name               = 'test-db'
  
     start_time            = time.time()
-
-    path                  = array_path + '/' + key
-    print('LOADING %s FEATURE ARRAY...'%key)
-    data                  = np.load(path + '/data.npy')
-    print('LOADING %s FEATURE INDEX...'%key)
-    data_index            = np.load(path + '/index.npy')
+    
+    keys                  = [key] if isinstance(key, str) else list(key)
+    tables                = FeatureTables(keys)
+    if append and mode not in ['streaming', 'pipeline']:
+        raise ValueError('append is only supported in streaming and pipeline mode')
+    if storage == 'blob' and mode == 'batch':
+        raise ValueError('blob storage is only supported in streaming, pipeline and sharded mode')
+    if backend != 'sqlite' and (mode not in ['streaming', 'pipeline'] or storage == 'blob'):
+        raise ValueError('the %s backend is only supported in streaming and pipeline mode, without --storage blob'%backend)
+    if append and not OUTPUT_BACKENDS[backend].supports_manifest:
+        raise ValueError('the %s backend keeps no manifest, so it cannot be appended to'%backend)
+    OUTPUT_BACKENDS[backend].check_dependencies()
+    selection             = ParseSelection(select,subsample,seed)
+    if mode != 'batch':
+        RequirePicklable(selection,mode)
+    if metrics_path is None:
+        metrics_path      = outdir + '/%s/meta/metrics.json'%db_name
+    metrics               = Metrics(progress,mode = mode,keys = keys,n_workers = n_workers,df_size = df_size,schema = schema,layout = layout,precision = precision,storage = storage,aggregate = aggregate,transform = transform,backend = backend,
+                                    select = None if select is None else [str(predicate) for predicate in ([select] if isinstance(select, str) or callable(select) else select)],subsample = subsample,seed = seed)
+    if memory_budget is not None:
+        memory_budget     = ParseMemory(memory_budget)
+        pulses, truth     = OpenArrays(array_path,keys,verbose = False)
+        pragmas           = ParsePragmas(pragmas)
+        plan              = PlanMemory(pulses,truth,memory_budget,n_workers,mode,fit_error,layout,storage,schema,aggregate,pragmas,backend)
+        del pulses, truth
+        if plan['cache_size'] is not None:
+            pragmas       = dict(pragmas or {}, cache_size = plan['cache_size'])
+        if mode != 'batch':
+            df_size       = plan['df_size']
+            n_workers     = plan['n_workers']
+        metrics.info.update(df_size = df_size,n_workers = n_workers,memory_plan = plan)
+    if mode == 'streaming':
+        StreamDataBase(array_path,db_name,keys,gcd_path,outdir,df_size,ParsePragmas(pragmas),schema,n_workers,fit_error,append,metrics,layout,precision,storage,aggregate,selection,transform,backend)
+        metrics.save(metrics_path)
+        print('DONE!')
+        print('Time Elapsed: %s min'%((time.time()-start_time)/60))
+        return
+    if mode == 'pipeline':
+        PipelineDataBase(array_path,db_name,keys,gcd_path,outdir,n_workers,df_size,ParsePragmas(pragmas),schema,fit_error,append,metrics,layout,precision,storage,aggregate,selection,transform,memory_budget,backend)
+        metrics.save(metrics_path)
+        print('DONE!')
+        print('Time Elapsed: %s min'%((time.time()-start_time)/60))
+        return
+    if mode == 'sharded':
+        ShardDataBase(array_path,db_name,keys,gcd_path,outdir,n_workers,df_size,ParsePragmas(pragmas),schema,fit_error,metrics,layout,precision,storage,aggregate,selection,transform)
+        metrics.save(metrics_path)
+        print('DONE!')
+        print('Time Elapsed: %s min'%((time.time()-start_time)/60))
+        return
 
     truth_key             = 'MCInIcePrimary'
     print('LOADING %s TRUTH ARRAY'%truth_key) 
     path_truth            = array_path + '/' + truth_key
-    truth                 = np.load(path_truth + '/' + 'data.npy')
-    
-    transformer_dict    = {'input':{}, 'truth':{}}
+    # with a selection the arrays are memory-mapped, so only the selected events and their pulses are read into memory
+    mmap_mode             = None if selection is None else 'r'
+    event_no              = None
+    with metrics.stage('load') as stage:
+        truth             = np.load(path_truth + '/' + 'data.npy', mmap_mode = mmap_mode)
+        if len(truth) == 0:
+            raise ValueError('%s holds no events'%array_path)
+        if selection is not None:
+            selected      = SelectEvents(truth,0,selection)
+            print('SELECTED %s OF %s EVENTS'%(len(selected),len(truth)))
+            if len(selected) == 0:
+                raise ValueError('The selection keeps no events')
+            truth         = truth[selected]
+            event_no      = selected + 1
+        stage.rows        = len(truth)
     
     ####################################
     #                                  #
@@ -163,27 +1732,9 @@ def CreateDataBase(array_path,db_name,key,gcd_path,outdir,n_workers):
     ####################################
     
     print('EXTRACTING TRUTH VALUES FOR %s EVENTS..'%(len(truth['pdg_encoding']) + 1))        
-    truth           = pd.concat([pd.DataFrame(np.arange(1,len(truth['pdg_encoding']) + 1)),
-                                 pd.DataFrame(truth['energy']),
-                                 pd.DataFrame(truth['time']),
-                                 pd.DataFrame(truth['pos']['x']),
-                                 pd.DataFrame(truth['pos']['y']),
-                                 pd.DataFrame(truth['pos']['z']),
-                                 pd.DataFrame(truth['dir']['azimuth']),
-                                 pd.DataFrame(truth['dir']['zenith']),
-                                 pd.DataFrame(truth['pdg_encoding']),
-                                 pd.DataFrame(truth['length'])]
-                                ,axis = 1)
-    truth.columns   = ['event_no',
-                       'energy_log10',
-                       'time',
-                       'position_x',
-                       'position_y',
-                       'position_z',
-                       'azimuth',
-                       'zenith',
-                       'pid',
-                       'muon_track_length']
+    with metrics.stage('extract') as stage:
+        truth       = ExtractTruth(truth,event_no = event_no)
+        stage.rows  = len(truth)
     
     #feats = str('event_no,x,y,z,time,charge_log10')
     #truths = str('event_no,energy_log10,time,vertex_x,vertex_y,vertex_z,direction_x,direction_y,direction_z,azimuth,zenith,pid)
@@ -194,143 +1745,72 @@ def CreateDataBase(array_path,db_name,key,gcd_path,outdir,n_workers):
     ####################################
     print('EXTRACTING FEATURES ...')
     geo                 = GrabGCD(gcd_path)
-    hits_idx            = data_index
-    hits                = data
-    single_hits         = np.empty(hits.shape + (5,))
-    event_no            = np.empty((len(hits),))
-    string_idx          = hits['key']['string'] - 1
-    om_idx              = hits['key']['om'] - 1
-    single_hits[:, 0:3] = geo[string_idx, om_idx]
-    single_hits[:, 3]   = hits['pulse']['time']
-    single_hits[:, 4]   = hits['pulse']['charge']
-    
-    print('EXTRACTING GEO-SPATIAL DOM DATA')
-    for i in range(len(hits_idx)):
-        this_idx = hits_idx[i]
-        event_no[this_idx['start'] : this_idx['stop']] = i + 1
-    
-    features            = pd.concat([pd.DataFrame(event_no),
-                                      pd.DataFrame(single_hits)]
-                                      ,axis = 1)
-    features.columns    = ['event_no',
-                            'dom_x',
-                            'dom_y',
-                            'dom_z',
-                            'dom_time',
-                            'charge_log10']
-    del single_hits
-    del event_no
+    features            = {}
+    dom_ids             = {}
+    doms                = {}
+    for key in keys:
+        path            = array_path + '/' + key
+        with metrics.stage('load') as stage:
+            print('LOADING %s FEATURE ARRAY...'%key)
+            data        = np.load(path + '/data.npy', mmap_mode = mmap_mode)
+            print('LOADING %s FEATURE INDEX...'%key)
+            data_index  = np.load(path + '/index.npy')
+            if selection is not None:
+                data, data_index, rows = SelectPulses(data,data_index,selected)
+            stage.rows  = len(data)
+        print('EXTRACTING GEO-SPATIAL DOM DATA')
+        with metrics.stage('extract') as stage:
+            features[tables[key]] = ExtractFeatures(data,data_index,geo,event_no = event_no)
+            if layout == 'compact':
+                dom_ids[tables[key]] = DomIds(data,geo)
+            if aggregate:
+                doms[tables[key]] = DomSummary(data,data_index,geo,layout = layout,event_no = event_no)
+            stage.rows  = len(data)
+        del data
     
     ####################################
     #                                  #
     #          PREPROCESSING           #
     #                                  #
     ####################################    
-    truth_keys          = truth.columns
-    feature_keys        = features.columns
-    feature_keys        = feature_keys[feature_keys != 'event_no']
-    
-    truth_keys          = truth_keys[truth_keys != 'event_no']
-    truth_keys          = truth_keys[truth_keys != 'pid']
-    
-    
-    
-    for key in feature_keys:
-        print('FITTING %s TRANSFORMER' %key)
-        scaler          = RobustScaler()
-        scaler          = scaler.fit(np.array(features[key]).reshape(-1,1))
-        features[key]   = scaler.transform(np.array(features[key]).reshape(-1,1))
-        transformer_dict['input'][key] = scaler
-    
-    for key in truth_keys:
-        print('FITTING %s TRANSFORMER' %key)
-        scaler          = RobustScaler()
-        scaler          = scaler.fit(np.array(truth[key]).reshape(-1,1))
-        truth[key]      = scaler.transform(np.array(truth[key]).reshape(-1,1))
-        transformer_dict['truth'][key] = scaler
+    n_rows              = len(truth) + sum([len(features[table]) for table in features.keys()])
+    with metrics.stage('fit') as stage:
+        transformer_dict = FitTransformers(features,truth)
+        stage.rows      = n_rows
+    applied             = AppliedTransformers(transformer_dict,transform)
+    with metrics.stage('transform') as stage:
+        for table in features.keys():
+            if layout == 'compact':
+                features[table] = CompactFeatures(features[table],dom_ids.pop(table))   # dom_x/y/z were only needed for fitting
+            features[table] = SetPrecision(ApplyTransformers(features[table],applied[InputSection(table)]),precision)
+            if schema == 'indexed':
+                features[table] = AddPulseIndex(features[table])
+        for table in doms.keys():
+            features[DomTable(table)] = SetPrecision(ApplyTransformers(doms[table],applied[InputSection(table)]),precision)
+        truth           = SetPrecision(ApplyTransformers(truth,applied['truth']),precision)
+        stage.rows      = n_rows
     
     ####################################
     #                                  #
     #      CREATE SQLite DATABASE      #
     #                                  #
     ####################################
-    print('SAVING TRANSFORMERS..')
+    db_path, transformer_path = MakeOutputDirectories(outdir,db_name)
+    SaveTransformers(transformer_dict,transformer_path)
     
-    transformer_path = outdir + '/' + '/%s/'%db_name + 'meta'
-    db_path          = outdir + '/' + '/%s/'%db_name + 'data'
-    os.makedirs(db_path)
-    os.makedirs(transformer_path)
-    tmp = open(transformer_path + '/transformers.pkl', 'wb')
-    pickle.dump(transformer_dict, tmp)
-    tmp.close()
-    
-    # 
-    #  INITIAL TRUTH COMMIT
-    #  Creates and commits 10 rows of data in 'truth' table in SQLite DataBase 
-    #
-
-    df_size    = 100000  # This sets the size of each commit of the workers. Keep this low to maintain low memory usage
-    print('MAKING INTIAL TRUTH COMMIT')
-    truth_initial           = truth.loc[0:10,:]
-    engine = sqlalchemy.create_engine('sqlite:///'+db_path + '/%s.db'%db_name)
-    truth_initial.to_sql('truth',engine,index= False, if_exists = 'append')
-    engine.dispose()  
-    
-    #
-    # INITIAL FEATURES COMMIT
-    # Creates and commits 10 rows of data in 'features' table in SQLite DataBase
-    #
-    print('MAKING INITIAL FEATURES COMMIT')
-    features_initial      = features.loc[0:10,:]
-    engine = sqlalchemy.create_engine('sqlite:///'+db_path + '/%s.db'%db_name)
-    features_initial.to_sql('features',engine,index= False, if_exists = 'append')
-    engine.dispose()
-    
-    #
-    #  MULTI-PROCESSING 
-    # 'FillStack' provides a multiprocessing.Queue() full of pd.DataFrames() with df_size rows for each worker.  
-    #  Each worker then fills a temporary database with these pd.DataFrames() using pd.to_sql()
-    #
-    
-        
-
-    manager = multiprocessing.Manager()
-    db_path = 'sqlite:///'+db_path + '/%s.db'%db_name
-
-    settings_features = FillStack(n_workers, features, df_size, manager, 'features', db_path) # Arguments for FillStack
-    settings_truth    = FillStack(n_workers, truth,df_size,manager,'truth',db_path)
-    
-    del truth   # To keep memory usage low. The data is now stored in chunks in multiprocessing.Queue()'s via FillStack(), so it's fine
+    data_tables         = {'truth': truth}
+    data_tables.update(features)
+    del truth   # To keep memory usage low. WriteTemporaries empties data_tables once the rows are handed to the workers
     del features#
-        
-    
-    p = Pool(processes = n_workers)
-    p.map(WriteToDB, settings_truth)   # This fills the rest of the table 'truth' using n_workers
-    p.map(WriteToDB, settings_features)# This fills the rest of the table 'features' using n_workers when  the line above is done
-    p.close()
-    p.join()
+    WriteTemporaries(data_tables,db_path + '/%s.db'%db_name,n_workers,df_size,ParsePragmas(pragmas),schema,transport,metrics)
     
     print('Temporary Databases created! Merging...')
-    
-    #
-    #
-    # MERGING
-    # Here the temporary databases are merged using a single core
-    # 
-    path = outdir + '/' + db_name + '/data'
-   
-    main_db, tmp = MergeTemporaries(path)
-    tables       = ['truth', 'features']
-    engine_main = sqlalchemy.create_engine('sqlite:///' + path + '/' + main_db)
-    for j in range(0,len(tmp)):
-        for k in range(0,len(tables)):
-            with sqlite3.connect(path + '/' + tmp[j] ) as con:
-                query      = 'select * from %s'%tables[k]
-                data_batch = pd.read_sql(query, con)
-            engine_tmp  = sqlalchemy.create_engine('sqlite:///' + path + '/' + tmp[j])    
-            data_batch.to_sql(tables[k],engine_main,index= False, if_exists = 'append',chunksize = len(data_batch))
-        print('MERGING %s / %s'%(j,len(tmp)))
-    engine_main.dispose() 
+    MergeTemporaryDataBases(db_path,['truth'] + OutputTables(keys,storage,aggregate),delete_temporaries,ParsePragmas(pragmas),schema,metrics)
+    writer              = SQLiteWriter(db_path + '/%s.db'%db_name,ParsePragmas(pragmas),schema = schema)
+    writer.register_settings(OutputSettings(keys,layout,schema,storage,precision,aggregate))
+    WriteMetadata(writer,geo,tables.values(),transformer_dict,layout,precision,storage,transform)
+    writer.close()
+    metrics.save(metrics_path)
    
     print('DONE!')
     print('Time Elapsed: %s min'%((time.time()-start_time)/60))    
@@ -0,0 +1,210 @@
+import numpy as np
+import os
+import queue
+import sqlite3
+import threading
+import json
+from collections import OrderedDict
+from numpy.lib.recfunctions import structured_to_unstructured
+
+from shard_router import ShardRouter, MAX_VARIABLES
+from transforms import ReadTransforms
+
+# PRAGMAs of the read-only connections. mmap_size lets SQLite read pages straight from the page cache of the OS
+# instead of copying them through its own cache; cache_size is per connection.
+READ_PRAGMAS = {'query_only' : 'ON',
+                'mmap_size'  : 2**30,
+                'cache_size' : -262144,   # negative means KiB, i.e. 256 MiB
+                'temp_store' : 'MEMORY'}
+
+class EventReader:
+    # Batched reader for training loops. Takes a database written by create_databasev2.py, or the catalog of a
+    # sharded one, and returns numpy arrays instead of DataFrames:
+    #   event_no  (n_events,)               the requested event numbers, in the requested order
+    #   truth     (n_events, n_truth)       truth_columns of each event
+    #   features  (n_pulses, n_features)    feature_columns of all pulses, event after event
+    #   offsets   (n_events + 1,)           pulses of event i are features[offsets[i]:offsets[i+1]]
+    # Recently read events are kept in an LRU cache of cache_events events, and iterate() reads the next
+    # batches on a background thread. Lookups by event_no scan the whole table in the 'plain' schema, so
+    # databases meant for training should be written with --schema indexed. In the compact layout dom_id is
+    # replaced by dom_x, dom_y and dom_z from the geometry table, so both layouts give the same features.
+    # Databases written with --storage blob are read from <table>_blob, one row and one np.frombuffer per batch.
+    # With scaled = True the values come back scaled by the transformers, also from databases written with
+    # --transform lazy, and with scaled = False in their original units. Both use the transforms table and numpy only.
+    def __init__(self,path,table = 'features',truth_columns = None,feature_columns = None,cache_events = 100000,pragmas = None,scaled = True):
+        if path.endswith('.json'):
+            self.router = ShardRouter(path)
+            self.files  = self.router.files
+        else:
+            self.router = None
+            self.files  = [path]
+        self.table        = table
+        self.pragmas      = dict(READ_PRAGMAS)
+        if pragmas is not None:
+            self.pragmas.update(pragmas)
+        self.local        = threading.local()
+        self.lock         = threading.Lock()
+        self.opened       = []
+        self.cache        = OrderedDict()
+        self.cache_events = cache_events
+        con               = self.connection(0)
+        self.blob_dtype   = None
+        if len(con.execute('PRAGMA table_info(%s)'%table).fetchall()) == 0 and len(con.execute('PRAGMA table_info(%s_blob)'%table).fetchall()) > 0:
+            descr           = json.loads(con.execute('SELECT dtype FROM blob_dtypes WHERE name = ?', (table + '_blob',)).fetchone()[0])
+            self.blob_dtype = np.dtype([tuple(field) for field in descr])
+        self.truth_columns   = truth_columns if truth_columns is not None else [row[1] for row in con.execute('PRAGMA table_info(truth)') if row[1] != 'event_no']
+        if self.blob_dtype is not None:
+            self.feature_columns = list(self.blob_dtype.names)
+        else:
+            self.feature_columns = feature_columns if feature_columns is not None else [row[1] for row in con.execute('PRAGMA table_info(%s)'%table) if row[1] not in ['event_no', 'pulse_idx']]
+        if len(self.truth_columns) == 0 or len(self.feature_columns) == 0:
+            raise ValueError('%s has no truth or %s table'%(path,table))
+        self.stored_columns  = self.feature_columns
+        self.geometry        = None
+        geometry             = 'geometry' + table[len('features'):]
+        if 'dom_id' in self.stored_columns and len(con.execute('PRAGMA table_info(%s)'%geometry).fetchall()) > 0:
+            rows             = np.array(con.execute('SELECT dom_id, dom_x, dom_y, dom_z FROM %s'%geometry).fetchall(), dtype = np.float64)
+            self.geometry    = np.zeros((int(rows[:, 0].max()) + 1, 3))
+            self.geometry[rows[:, 0].astype(np.int64)] = rows[:, 1:]
+            self.feature_columns = ['dom_x', 'dom_y', 'dom_z'] + [column for column in self.stored_columns if column != 'dom_id']
+        self.scaled          = scaled
+        self.transforms      = ReadTransforms(con)
+        if self.transforms is None and not scaled:
+            raise ValueError('%s has no transforms table, so its values cannot be unscaled'%path)
+
+    def rescale(self,table,columns,values):
+        # Stored values -> scaled values (scaled = True) or values in their original units (scaled = False)
+        if self.transforms is None or self.transforms.applied == self.scaled:
+            return values
+        if self.scaled:
+            return self.transforms.transform(table,columns,values)
+        return self.transforms.inverse(table,columns,values)
+
+    def connection(self,shard):
+        # One read-only connection per shard, thread and process
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connections = {}
+            self.local.pid         = os.getpid()
+        if shard not in self.local.connections:
+            con = sqlite3.connect('file:%s?mode=ro'%self.files[shard], uri = True, check_same_thread = False)
+            for pragma in self.pragmas.keys():
+                con.execute('PRAGMA %s = %s'%(pragma,self.pragmas[pragma]))
+            self.local.connections[shard] = con
+            with self.lock:
+                self.opened.append(con)
+        return self.local.connections[shard]
+
+    def route(self,event_nos):
+        if self.router is None:
+            return {0: event_nos}
+        return self.router.route(event_nos)
+
+    def fetch(self,event_nos):
+        # Reads the events from the database. Returns {event_no: [truth row, pulses]}.
+        events = {}
+        for shard, shard_events in self.route(event_nos).items():
+            con = self.connection(shard)
+            for start in range(0, len(shard_events), MAX_VARIABLES):
+                batch     = shard_events[start:start + MAX_VARIABLES].tolist()
+                where     = 'WHERE event_no IN (%s)'%', '.join(['?']*len(batch))
+                truth     = np.array(con.execute('SELECT event_no, %s FROM truth %s'%(', '.join(self.truth_columns),where), batch).fetchall(), dtype = np.float64).reshape(-1, len(self.truth_columns) + 1)
+                if self.blob_dtype is not None:
+                    pulses = self.unpack(con.execute('SELECT event_no, n_pulses, pulses FROM %s_blob %s'%(self.table,where), batch).fetchall())
+                else:
+                    pulses = np.array(con.execute('SELECT event_no, %s FROM %s %s'%(', '.join(self.stored_columns),self.table,where), batch).fetchall(), dtype = np.float64).reshape(-1, len(self.stored_columns) + 1)
+                if self.geometry is not None:
+                    dom_id    = 1 + self.stored_columns.index('dom_id')
+                    pulses    = np.column_stack([pulses[:, 0], self.geometry[pulses[:, dom_id].astype(np.int64)], np.delete(pulses[:, 1:], dom_id - 1, axis = 1)])
+                truth[:, 1:]  = self.rescale('truth',self.truth_columns,truth[:, 1:])
+                pulses[:, 1:] = self.rescale(self.table,self.feature_columns,pulses[:, 1:])
+                # group the pulses by event without changing their order within an event
+                order     = np.argsort(pulses[:, 0], kind = 'stable')
+                pulses    = pulses[order]
+                event_no, first = np.unique(pulses[:, 0].astype(np.int64), return_index = True)
+                bounds    = dict(zip(event_no.tolist(), zip(first.tolist(), np.append(first[1:], len(pulses)).tolist())))
+                for row in truth:
+                    start_pulse, stop_pulse = bounds.get(int(row[0]), (0, 0))
+                    events[int(row[0])] = [row[1:], pulses[start_pulse:stop_pulse, 1:]]
+        return events
+
+    def unpack(self,rows):
+        # Packed events -> the same array of event_no + stored columns as a row query gives
+        if len(rows) == 0:
+            return np.empty((0, len(self.stored_columns) + 1))
+        event_no, n_pulses, blobs = zip(*rows)
+        packed    = np.frombuffer(b''.join(blobs), dtype = self.blob_dtype)
+        return np.column_stack([np.repeat(np.array(event_no, dtype = np.float64), n_pulses), structured_to_unstructured(packed, dtype = np.float64)])
+
+    def read(self,event_nos):
+        event_nos = np.asarray(event_nos, dtype = np.int64)
+        events    = {}
+        with self.lock:
+            for event in event_nos.tolist():
+                if event in self.cache:
+                    self.cache.move_to_end(event)
+                    events[event] = self.cache[event]
+        missing   = np.array([event for event in np.unique(event_nos).tolist() if event not in events], dtype = np.int64)
+        if len(missing) > 0:
+            fetched = self.fetch(missing)
+            if len(fetched) < len(missing):
+                raise KeyError('event_no %s not in the database'%[event for event in missing.tolist() if event not in fetched][:10])
+            events.update(fetched)
+            with self.lock:
+                for event in fetched.keys():
+                    self.cache[event] = fetched[event]
+                while len(self.cache) > self.cache_events:
+                    self.cache.popitem(last = False)
+        lengths   = np.array([len(events[event][1]) for event in event_nos.tolist()], dtype = np.int64)
+        return {'event_no': event_nos,
+                'truth': np.stack([events[event][0] for event in event_nos.tolist()]) if len(event_nos) > 0 else np.empty((0, len(self.truth_columns))),
+                'features': np.concatenate([events[event][1] for event in event_nos.tolist()]) if len(event_nos) > 0 else np.empty((0, len(self.feature_columns))),
+                'offsets': np.concatenate([[0], np.cumsum(lengths)])}
+
+    def iterate(self,event_nos,batch_size,prefetch = 2):
+        # Yields read() of consecutive batches of event_nos, while up to prefetch further batches are read on a
+        # background thread. sqlite3 releases the GIL while it steps through a query, so the reads overlap with the caller.
+        event_nos = np.asarray(event_nos, dtype = np.int64)
+        batches   = queue.Queue(maxsize = max(1,prefetch))
+        stop      = threading.Event()
+
+        def Put(item):
+            # gives up when the caller has stopped iterating
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout = 0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def Prefetch():
+            try:
+                for start in range(0, len(event_nos), batch_size):
+                    if not Put(self.read(event_nos[start:start + batch_size])):
+                        return
+            except Exception as error:
+                Put(error)
+                return
+            Put(None)
+
+        thread = threading.Thread(target = Prefetch, daemon = True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def close(self):
+        with self.lock:
+            for con in self.opened:
+                con.close()
+            self.opened = []
+            self.cache.clear()
+        self.local = threading.local()
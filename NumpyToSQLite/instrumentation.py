@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import resource
+
+def PeakRSS():
+    # High-water mark of the resident set size of this process, in MB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def ChildrenPeakRSS():
+    # Largest high-water mark among the finished child processes of this process (e.g. Pool workers), in MB
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024
+
+def CurrentRSS(pid = None):
+    # Resident set size of a process right now, in MB. Read from /proc, so 0 where that does not exist
+    # (and for processes that have exited); PeakRSS is the fallback for this process.
+    try:
+        with open('/proc/%s/statm'%(pid if pid is not None else 'self'), 'r') as tmp:
+            return int(tmp.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError):
+        return PeakRSS() if pid is None or pid == os.getpid() else 0.0
+
+def TreeRSS(pids):
+    # Summed resident set size of the given processes, in MB. Pages shared after a fork are counted in every process,
+    # so this overestimates what they use together.
+    return sum([CurrentRSS(pid) for pid in pids])
+
+def FileSize(path):
+    # Size of an SQLite database on disk including its -wal/-journal file, in bytes.
+    # For a directory (e.g. the output of the parquet backend) the summed size of its files.
+    if os.path.isdir(path):
+        return sum([FileSize(os.path.join(path, name)) for name in os.listdir(path)])
+    size = 0
+    for suffix in ['', '-wal', '-journal']:
+        if os.path.isfile(path + suffix):
+            size += os.path.getsize(path + suffix)
+    return size
+
+def WorkerStats(stage,start,rows = 0,bytes_written = 0):
+    # What a worker process sends back to the parent about one piece of work, for Metrics.add_worker
+    return {'pid': os.getpid(),
+            'stage': stage,
+            'seconds': time.time() - start,
+            'rows': int(rows),
+            'bytes_written': int(bytes_written),
+            'peak_rss_mb': PeakRSS()}
+
+class StageTimer:
+    # with metrics.stage('write') as stage: ... stage.rows += n
+    def __init__(self,metrics,name):
+        self.metrics       = metrics
+        self.name          = name
+        self.rows          = 0
+        self.bytes_written = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self,exc_type,exc_value,exc_traceback):
+        self.metrics.add(self.name,time.time() - self.start,self.rows,self.bytes_written)
+        return False
+
+class Metrics:
+    # Collects wall time, rows processed, bytes written and peak RSS for each stage of a conversion and for each
+    # worker process. Repeated stages (e.g. one per chunk) are accumulated. report() gives a JSON-serializable summary.
+    def __init__(self,progress = False,**info):
+        self.start_time = time.time()
+        self.show_progress = progress
+        self.info       = info
+        self.stages     = {}
+        self.workers    = {}
+
+    def stage(self,name):
+        return StageTimer(self,name)
+
+    def add(self,name,seconds,rows = 0,bytes_written = 0):
+        if name not in self.stages:
+            self.stages[name] = {'stage': name, 'seconds': 0.0, 'rows': 0, 'bytes_written': 0, 'calls': 0}
+        record = self.stages[name]
+        record['seconds']       += seconds
+        record['rows']          += int(rows)
+        record['bytes_written'] += int(bytes_written)
+        record['calls']         += 1
+        record['peak_rss_mb']    = PeakRSS()
+
+    def add_worker(self,stats):
+        key = (stats['pid'], stats['stage'])
+        if key not in self.workers:
+            self.workers[key] = {'pid': stats['pid'], 'stage': stats['stage'], 'seconds': 0.0, 'rows': 0, 'bytes_written': 0, 'calls': 0, 'peak_rss_mb': 0.0}
+        record = self.workers[key]
+        record['seconds']       += stats['seconds']
+        record['rows']          += stats['rows']
+        record['bytes_written'] += stats['bytes_written']
+        record['calls']         += 1
+        record['peak_rss_mb']    = max(record['peak_rss_mb'], stats['peak_rss_mb'])
+
+    def progress(self,done,total,rows):
+        # Live progress line on stderr, rewritten in place. Returns False when progress is switched off,
+        # so the caller can print its usual message instead.
+        if not self.show_progress:
+            return False
+        elapsed = time.time() - self.start_time
+        sys.stderr.write('\r%s / %s chunks | %s rows | %.0f rows/sec | %.0f s | peak RSS %.0f MB   '%(done,total,rows,rows/max(elapsed,1e-9),elapsed,PeakRSS()))
+        if done == total:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+        return True
+
+    def report(self):
+        stages  = []
+        for record in list(self.stages.values()) + list(self.workers.values()):
+            record = dict(record)
+            record['rows_per_sec'] = record['rows']/max(record['seconds'], 1e-9)
+            stages.append(record)
+        report  = dict(self.info)
+        report['total_seconds']        = time.time() - self.start_time
+        report['peak_rss_mb']          = PeakRSS()
+        report['children_peak_rss_mb'] = ChildrenPeakRSS()
+        report['stages']               = [record for record in stages if 'pid' not in record]
+        report['workers']              = [record for record in stages if 'pid' in record]
+        return report
+
+    def save(self,path):
+        print('SAVING METRICS TO %s'%path)
+        with open(path, 'w') as tmp:
+            json.dump(self.report(), tmp, indent = 1)
+        return
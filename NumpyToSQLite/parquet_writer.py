@@ -0,0 +1,159 @@
+import os
+import numpy as np
+import pandas as pd
+
+from transforms import TRANSFORMS_TABLE, Transforms
+
+# pyarrow is only needed for --backend parquet and for reading its output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Codec of the column chunks. zstd compresses the float columns about as well as gzip at close to snappy speed.
+PARQUET_COMPRESSION = 'zstd'
+
+def RequireArrow():
+    if pa is None:
+        raise ImportError('The parquet backend needs pyarrow, e.g. pip install pyarrow')
+    return
+
+def TableFile(path,table):
+    # Every table of a Parquet output is its own file in the output directory: <db_name>.parquet/<table>.parquet
+    return path + '/%s.parquet'%table
+
+class ParquetWriter:
+    # Output backend with the interface of SQLiteWriter (see OUTPUT_BACKENDS), writing every table to a Parquet file
+    # under the directory path. The rows passed to write() since the last commit() become one row group per table,
+    # so the row groups of truth and features follow the event-aligned chunks of the converter and their event_no
+    # statistics tell readers which events they hold (see ReadParquet). Files are created on first write, with
+    # the schema of the first chunk; later chunks are cast to it. With transaction_size the row group is also
+    # written once that many rows are waiting. pragmas and schema are accepted for SQLiteWriter compatibility.
+    # There is no manifest: an output holds one source, written in one go.
+    supports_manifest = False
+
+    @staticmethod
+    def check_dependencies():
+        RequireArrow()
+
+    def __init__(self,path,pragmas = None,transaction_size = None,schema = 'plain',compression = PARQUET_COMPRESSION):
+        RequireArrow()
+        self.db_file          = path
+        self.schema           = schema
+        self.transaction_size = transaction_size
+        self.compression      = compression
+        self.pending          = 0
+        self.buffers          = {}
+        self.writers          = {}
+        self.empty            = {}
+        os.makedirs(path, exist_ok = True)
+
+    def write(self,table,columns):
+        # columns is a pd.DataFrame or a dict of equally long numpy arrays
+        if isinstance(columns, pd.DataFrame):
+            columns = {column: columns[column].to_numpy() for column in columns.columns}
+        arrays    = pa.table({column: pa.array(np.asarray(columns[column])) for column in columns.keys()})
+        if arrays.num_rows == 0:
+            self.empty.setdefault(table,arrays)
+            return
+        self.buffers.setdefault(table,[]).append(arrays)
+        self.pending += arrays.num_rows
+        if self.transaction_size is not None and self.pending >= self.transaction_size:
+            self.commit()
+
+    def commit(self):
+        for table in self.buffers.keys():
+            if table not in self.writers:
+                self.writers[table] = pq.ParquetWriter(TableFile(self.db_file,table),self.buffers[table][0].schema,
+                                                       compression = self.compression,write_statistics = True)
+            arrays = pa.concat_tables([arrays.cast(self.writers[table].schema) for arrays in self.buffers[table]])
+            self.writers[table].write_table(arrays, row_group_size = arrays.num_rows)
+        self.buffers = {}
+        self.pending = 0
+
+    def close(self):
+        # Tables that only ever got empty chunks are written without row groups, so that every table exists
+        self.commit()
+        for table in self.empty.keys():
+            if table not in self.writers:
+                pq.write_table(self.empty[table],TableFile(self.db_file,table),compression = self.compression)
+        for table in self.writers.keys():
+            self.writers[table].close()
+        self.writers = {}
+
+    def finish(self):
+        self.close()
+
+    def has_table(self,table):
+        return table in self.writers or table in self.buffers or table in self.empty or os.path.isfile(TableFile(self.db_file,table))
+
+    def write_metadata(self,table,columns,keys):
+        # Small tables written once per output are written as a whole file. Rows replace the rows with the same keys.
+        if isinstance(columns, pd.DataFrame):
+            columns = {column: columns[column].to_numpy() for column in columns.columns}
+        rows     = pd.DataFrame({column: np.asarray(columns[column]) for column in columns.keys()})
+        existing = self.read_metadata(table)
+        if existing is not None:
+            rows = pd.concat([pd.DataFrame(existing), rows], ignore_index = True).drop_duplicates(keys, keep = 'last')
+        arrays   = pa.table({column: pa.array(rows[column].to_numpy()) for column in rows.columns})
+        pq.write_table(arrays,TableFile(self.db_file,table),compression = self.compression)
+
+    def read_metadata(self,table):
+        # A table written with write_metadata as {column: list}, or None if there is none
+        if not os.path.isfile(TableFile(self.db_file,table)):
+            return None
+        return pq.read_table(TableFile(self.db_file,table)).to_pydict()
+
+    def register_settings(self,settings):
+        return
+
+    def register_source(self,source,n_events):
+        # event_no starts at 1, as for the first source of a SQLite database
+        return 0
+
+    def committed_chunks(self,source):
+        return []
+
+    def commit_chunk(self,source,first,last):
+        self.commit()
+
+def EventRowGroups(parquet_file,first_event = None,last_event = None):
+    # Row groups that can hold events with first_event <= event_no <= last_event, from the event_no statistics
+    column = parquet_file.schema_arrow.get_field_index('event_no')
+    groups = []
+    for j in range(parquet_file.num_row_groups):
+        statistics = parquet_file.metadata.row_group(j).column(column).statistics
+        if statistics is not None and statistics.has_min_max:
+            if (first_event is not None and statistics.max < first_event) or (last_event is not None and statistics.min > last_event):
+                continue
+        groups.append(j)
+    return groups
+
+def ReadParquet(path,table = 'features',columns = None,first_event = None,last_event = None):
+    # Reads columns (default all) of the events first_event <= event_no <= last_event of one table of a Parquet
+    # output, memory-mapped. Only the row groups whose event_no range overlaps are read. Returns {column: numpy array}.
+    RequireArrow()
+    parquet_file = pq.ParquetFile(TableFile(path,table), memory_map = True)
+    names        = parquet_file.schema_arrow.names if columns is None else list(columns)
+    read         = names if 'event_no' in names else names + ['event_no']
+    arrays       = parquet_file.read_row_groups(EventRowGroups(parquet_file,first_event,last_event), columns = read)
+    event_no     = arrays.column('event_no').to_numpy()
+    mask         = np.ones(len(event_no), dtype = bool)
+    if first_event is not None:
+        mask    &= event_no >= first_event
+    if last_event is not None:
+        mask    &= event_no <= last_event
+    return {name: arrays.column(name).to_numpy()[mask] for name in names}
+
+def ReadParquetTransforms(path):
+    # The transforms table of a Parquet output as transforms.Transforms, or None if it has none
+    RequireArrow()
+    if not os.path.isfile(TableFile(path,TRANSFORMS_TABLE)):
+        return None
+    rows       = pq.read_table(TableFile(path,TRANSFORMS_TABLE)).to_pydict()
+    parameters = {}
+    for section, column, center, scale in zip(rows['section'],rows['column_name'],rows['center'],rows['scale']):
+        parameters.setdefault(section, {})[column] = [center, scale]
+    return Transforms(parameters, bool(rows['applied'][0]) if len(rows['applied']) > 0 else True)
@@ -0,0 +1,82 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import sqlite3
+
+MAX_VARIABLES = 999   # lowest SQLITE_MAX_VARIABLE_NUMBER of the sqlite3 builds we run on
+
+class ShardRouter:
+    # Read side of --mode sharded. Loads <db_name>_catalog.json and sends each query to the shards holding
+    # the requested event_no, so concurrent readers spread over the shard files instead of sharing one database.
+    # Connections are read-only and opened lazily per process, so a router can be created before forking
+    # (e.g. before the workers of a torch DataLoader start).
+    def __init__(self,catalog_file):
+        with open(catalog_file, 'r') as tmp:
+            catalog         = json.load(tmp)
+        directory           = os.path.dirname(os.path.abspath(catalog_file))
+        self.tables         = catalog['tables']
+        self.schema         = catalog['schema']
+        self.selected       = catalog.get('selected', False)
+        self.files          = [directory + '/' + shard['file'] for shard in catalog['shards']]
+        self.first_event_no = np.array([shard['first_event_no'] for shard in catalog['shards']], dtype = np.int64)
+        self.last_event_no  = np.array([shard['last_event_no'] for shard in catalog['shards']], dtype = np.int64)
+        self.connections    = {}
+        self.pid            = os.getpid()
+
+    def connection(self,shard):
+        if self.pid != os.getpid():
+            # connections must not be shared with a forked child
+            self.connections = {}
+            self.pid         = os.getpid()
+        if shard not in self.connections:
+            self.connections[shard] = sqlite3.connect('file:%s?mode=ro'%self.files[shard], uri = True, check_same_thread = False)
+        return self.connections[shard]
+
+    def locate(self,event_nos):
+        # Shard number of every event_no. Raises KeyError for event numbers that are in no shard.
+        event_nos  = np.asarray(event_nos, dtype = np.int64)
+        shards     = np.searchsorted(self.last_event_no, event_nos, side = 'left')
+        missing    = shards >= len(self.files)
+        missing[~missing] = event_nos[~missing] < self.first_event_no[shards[~missing]]
+        if np.any(missing):
+            raise KeyError('event_no %s not in any shard'%event_nos[missing][:10].tolist())
+        return shards
+
+    def route(self,event_nos):
+        # {shard: the event_no it holds}, keeping the order of event_nos within each shard
+        event_nos  = np.asarray(event_nos, dtype = np.int64)
+        shards     = self.locate(event_nos)
+        return {int(shard): event_nos[shards == shard] for shard in np.unique(shards)}
+
+    def query(self,table,event_nos,columns = '*'):
+        # Rows of table for the given events as one DataFrame, fetched shard by shard.
+        # Rows come back grouped by shard, in the order each shard returns them.
+        if table not in self.tables:
+            raise ValueError('%s is not one of the tables %s'%(table,self.tables))
+        if not isinstance(columns, str):
+            columns = ', '.join(columns)
+        frames = []
+        for shard, shard_events in self.route(event_nos).items():
+            for start in range(0, len(shard_events), MAX_VARIABLES):
+                batch = shard_events[start:start + MAX_VARIABLES].tolist()
+                query = 'SELECT %s FROM %s WHERE event_no IN (%s)'%(columns,table,', '.join(['?']*len(batch)))
+                frames.append(pd.read_sql(query, self.connection(shard), params = batch))
+        if len(frames) == 0:
+            return pd.read_sql('SELECT %s FROM %s LIMIT 0'%(columns,table), self.connection(0))
+        return pd.concat(frames, ignore_index = True)
+
+    def select(self,query,params = ()):
+        # Runs the same query on every shard and concatenates the results, e.g. 'SELECT event_no FROM truth WHERE pid = 14'
+        return pd.concat([pd.read_sql(query, self.connection(shard), params = params) for shard in range(len(self.files))], ignore_index = True)
+
+    def events(self):
+        # All event_no in the shards. Databases written with a selection only hold some of the event_no in each range.
+        if self.selected:
+            return self.select('SELECT event_no FROM truth ORDER BY event_no')['event_no'].to_numpy()
+        return np.concatenate([np.arange(first, last + 1) for first, last in zip(self.first_event_no, self.last_event_no)])
+
+    def close(self):
+        for con in self.connections.values():
+            con.close()
+        self.connections = {}
@@ -0,0 +1,130 @@
+import numpy as np
+import os
+import pickle
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+# Structured dtypes of the i3cols arrays read by create_databasev2.CreateDataBase
+PULSE_DTYPE = np.dtype([('key',   [('string', np.uint8),
+                                   ('om', np.uint8),
+                                   ('pmt', np.uint8)]),
+                        ('pulse', [('time', np.float32),
+                                   ('charge', np.float32),
+                                   ('width', np.float32),
+                                   ('flags', np.uint16)])])
+
+INDEX_DTYPE = np.dtype([('start', np.uint64),
+                        ('stop', np.uint64)])
+
+PARTICLE_DTYPE = np.dtype([('id', [('majorID', np.uint64),
+                                   ('minorID', np.int32)]),
+                           ('pdg_encoding', np.int32),
+                           ('shape', np.uint8),
+                           ('status', np.int8),
+                           ('pos', [('x', np.float64),
+                                    ('y', np.float64),
+                                    ('z', np.float64)]),
+                           ('dir', [('zenith', np.float64),
+                                    ('azimuth', np.float64)]),
+                           ('time', np.float64),
+                           ('energy', np.float64),
+                           ('length', np.float64),
+                           ('speed', np.float64),
+                           ('fit_status', np.int8),
+                           ('location_type', np.uint8)])
+
+N_STRINGS = 86
+N_DOMS    = 60
+
+def SyntheticGeometry(seed = 0):
+    # A gcd dict shaped like the output of i3ToNumpy/create_geo_array.py: strings on a rough hexagon, 60 DOMs each
+    rng          = np.random.default_rng(seed)
+    geo          = np.empty((N_STRINGS, N_DOMS, 3))
+    string_xy    = rng.uniform(-600, 600, (N_STRINGS, 2))
+    geo[:, :, 0] = string_xy[:, 0:1]
+    geo[:, :, 1] = string_xy[:, 1:2]
+    geo[:, :, 2] = np.linspace(500, -500, N_DOMS)[np.newaxis, :]
+    gcd          = {'source_gcd_name': 'synthetic',
+                    'source_gcd_md5': None,
+                    'source_gcd_i3_md5': None,
+                    'geo': geo,
+                    'noise': np.full((N_STRINGS, N_DOMS), 500.0),
+                    'rde': np.ones((N_STRINGS, N_DOMS))}
+    return gcd
+
+def SyntheticPulses(n_events,mean_pulses,rng):
+    counts                 = rng.poisson(mean_pulses, n_events) + 1
+    index                  = np.empty(n_events, dtype = INDEX_DTYPE)
+    index['stop']          = np.cumsum(counts)
+    index['start']         = index['stop'] - counts
+    n_pulses               = int(counts.sum())
+    data                   = np.zeros(n_pulses, dtype = PULSE_DTYPE)
+    data['key']['string']  = rng.integers(1, N_STRINGS + 1, n_pulses)
+    data['key']['om']      = rng.integers(1, N_DOMS + 1, n_pulses)
+    data['key']['pmt']     = 0
+    data['pulse']['time']  = rng.normal(10000, 1000, n_pulses)
+    data['pulse']['charge']= rng.exponential(1.0, n_pulses) + 0.25
+    data['pulse']['width'] = 8.0
+    return data, index
+
+def SyntheticTruth(n_events,rng):
+    truth                  = np.zeros(n_events, dtype = PARTICLE_DTYPE)
+    truth['id']['majorID'] = rng.integers(0, 2**63, n_events, dtype = np.uint64)
+    truth['pdg_encoding']  = rng.choice([-16, -14, -12, 12, 14, 16], n_events)
+    for axis in ['x', 'y', 'z']:
+        truth['pos'][axis] = rng.normal(0, 200, n_events)
+    truth['dir']['zenith'] = np.arccos(rng.uniform(-1, 1, n_events))
+    truth['dir']['azimuth']= rng.uniform(0, 2*np.pi, n_events)
+    truth['time']          = rng.normal(10000, 100, n_events)
+    truth['energy']        = 10**rng.uniform(0, 3, n_events)
+    truth['length']        = rng.exponential(100, n_events)
+    truth['speed']         = 0.299792458
+    return truth
+
+def CreateSyntheticArrays(outdir,n_events,keys = ['SplitInIcePulses'],mean_pulses = 20,seed = 0):
+    # Writes <outdir>/<key>/data.npy + index.npy for every key, <outdir>/MCInIcePrimary/data.npy
+    # and <outdir>/gcd/gcd.pkl, i.e. arguments for --array_path and --gcd_path of create_databasev2.py
+    rng = np.random.default_rng(seed)
+    for key in keys:
+        print('WRITING SYNTHETIC %s FOR %s EVENTS'%(key,n_events))
+        data, index = SyntheticPulses(n_events,mean_pulses,rng)
+        os.makedirs(outdir + '/' + key, exist_ok = True)
+        np.save(outdir + '/' + key + '/data.npy', data)
+        np.save(outdir + '/' + key + '/index.npy', index)
+        del data, index
+    os.makedirs(outdir + '/MCInIcePrimary', exist_ok = True)
+    np.save(outdir + '/MCInIcePrimary/data.npy', SyntheticTruth(n_events,rng))
+    os.makedirs(outdir + '/gcd', exist_ok = True)
+    with open(outdir + '/gcd/gcd.pkl', 'wb') as tmp:
+        pickle.dump(SyntheticGeometry(seed), tmp)
+    return outdir, outdir + '/gcd'
+
+def parse_args(description=__doc__):
+    """Parse command line args"""
+    parser = ArgumentParser(
+        description=description,
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--outdir', type=str, required=True,
+        help='Directory in which to write the synthetic arrays and gcd/gcd.pkl',
+    )
+    parser.add_argument(
+        '--n_events', type=int, required=True,
+        help='Number of events',
+    )
+    parser.add_argument(
+        '--keys', type=str, nargs='+', default=['SplitInIcePulses'],
+        help='Pulse series to generate',
+    )
+    parser.add_argument(
+        '--mean_pulses', type=float, default=20,
+        help='Mean number of pulses per event',
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed',
+    )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    CreateSyntheticArrays(**vars(parse_args()))
@@ -0,0 +1,49 @@
+import numpy as np
+
+# Metadata table with the RobustScaler parameters of a database, one row per scaled column. section is the section of
+# transformers.pkl ('truth', 'input' or 'input_<key>'), and applied is 1 if the stored values are already scaled
+# (--transform eager) or 0 if they are the raw values (--transform lazy).
+TRANSFORMS_TABLE = 'transforms'
+
+def Section(table):
+    # Section scaling the columns of a table: truth -> truth, features(_<key>), doms(_<key>), geometry(_<key>)
+    # and their _blob tables -> input(_<key>)
+    if table.endswith('_blob'):
+        table = table[:-len('_blob')]
+    for prefix in ['features', 'doms', 'geometry']:
+        if table.startswith(prefix):
+            return 'input' + table[len(prefix):]
+    return table
+
+def ReadTransforms(con):
+    # Transforms of the database behind con, or None if it was written without a transforms table
+    if len(con.execute('PRAGMA table_info(%s)'%TRANSFORMS_TABLE).fetchall()) == 0:
+        return None
+    parameters = {}
+    applied    = True
+    for section, column, center, scale, applied in con.execute('SELECT section, column_name, center, scale, applied FROM %s'%TRANSFORMS_TABLE):
+        parameters.setdefault(section, {})[column] = [center, scale]
+    return Transforms(parameters, bool(applied))
+
+class Transforms:
+    # numpy-only replacement for the RobustScalers of transformers.pkl. transform() gives (x - center)/scale and
+    # inverse() x*scale + center, for all columns of a 2D array at once. Columns without a scaler are left as they are.
+    # Readers only need numpy and the database, and a new scaling is a matter of changing parameters.
+    def __init__(self,parameters,applied = True):
+        self.parameters = parameters
+        self.applied    = applied
+
+    def vectors(self,table,columns):
+        # center and scale of every column, 0 and 1 for the columns that are not scaled
+        scalers = self.parameters.get(Section(table), {})
+        center  = np.array([scalers[column][0] if column in scalers else 0.0 for column in columns])
+        scale   = np.array([scalers[column][1] if column in scalers else 1.0 for column in columns])
+        return center, scale
+
+    def transform(self,table,columns,values):
+        center, scale = self.vectors(table,columns)
+        return (np.asarray(values, dtype = np.float64) - center)/scale
+
+    def inverse(self,table,columns,values):
+        center, scale = self.vectors(table,columns)
+        return np.asarray(values, dtype = np.float64)*scale + center
@@ -0,0 +1,286 @@
+import os
+import json
+import sqlite3
+import time
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import create_databasev2 as converter
+from shard_router import ShardRouter
+from transforms import ReadTransforms
+from parquet_writer import ReadParquetTransforms, TableFile
+
+# Largest allowed difference between the sum of a column over a chunk of events in the database and in the source
+# arrays, relative to the sum of the absolute source values. Single precision databases need about 1e-6.
+TOLERANCE = 1e-8
+
+# Number of rows of the event_no ranges reported for each kind of problem
+MAX_REPORTED = 10
+
+def DatabaseFiles(db):
+    # The files to scan: every shard of a catalog written by --mode sharded, or the database (or Parquet directory) itself
+    if db.endswith('.json'):
+        return ShardRouter(db).files
+    return [db]
+
+def IsParquet(db_file):
+    return os.path.isdir(db_file)
+
+def TableNames(db_file):
+    if IsParquet(db_file):
+        return [name[:-len('.parquet')] for name in os.listdir(db_file) if name.endswith('.parquet')]
+    con    = sqlite3.connect('file:%s?mode=ro'%db_file, uri = True)
+    tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    con.close()
+    return tables
+
+def SourceOffset(db_files,array_path):
+    # event_no offset of array_path, from the manifest of a database written in streaming, pipeline or convert_runs mode.
+    # Also tells whether the manifest lists other sources, whose events are then expected in the database as well.
+    for db_file in db_files:
+        if IsParquet(db_file) or 'manifest_sources' not in TableNames(db_file):
+            continue
+        con  = sqlite3.connect('file:%s?mode=ro'%db_file, uri = True)
+        rows = con.execute('SELECT source, event_offset FROM manifest_sources').fetchall()
+        con.close()
+        for source, event_offset in rows:
+            if source == os.path.abspath(array_path):
+                return int(event_offset), len(rows) > 1
+    return 0, False
+
+def ReadTableTransforms(db_file):
+    if IsParquet(db_file):
+        return ReadParquetTransforms(db_file)
+    con        = sqlite3.connect('file:%s?mode=ro'%db_file, uri = True)
+    transforms = ReadTransforms(con)
+    con.close()
+    return transforms
+
+def TableBlocks(db_file,table,block_size = 1000000):
+    # Scans table once in storage order and yields (columns, block) with block a float64 array of event_no and columns,
+    # block_size rows (or packed events) at a time. Blob tables are unpacked to one row per pulse.
+    if IsParquet(db_file):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(TableFile(db_file,table), memory_map = True)
+        columns      = [name for name in parquet_file.schema_arrow.names if name != 'event_no']
+        for batch in parquet_file.iter_batches(batch_size = block_size, columns = ['event_no'] + columns):
+            yield columns, np.column_stack([batch.column(j).to_numpy(zero_copy_only = False).astype(np.float64) for j in range(batch.num_columns)]).reshape(-1, 1 + len(columns))
+        return
+    con          = sqlite3.connect('file:%s?mode=ro'%db_file, uri = True)
+    try:
+        if table.endswith('_blob'):
+            dtype    = np.dtype([tuple(field) for field in json.loads(con.execute('SELECT dtype FROM blob_dtypes WHERE name = ?', (table,)).fetchone()[0])])
+            columns  = list(dtype.names)
+            cursor   = con.execute('SELECT event_no, n_pulses, pulses FROM %s'%table)
+            rows     = cursor.fetchmany(block_size)
+            while len(rows) > 0:
+                event_no, n_pulses, blobs = zip(*rows)
+                packed = np.frombuffer(b''.join(blobs), dtype = dtype)
+                yield columns, np.column_stack([np.repeat(np.array(event_no, dtype = np.float64), n_pulses), structured_to_unstructured(packed, dtype = np.float64)]).reshape(-1, 1 + len(columns))
+                rows   = cursor.fetchmany(block_size)
+            return
+        columns      = [row[1] for row in con.execute('PRAGMA table_info(%s)'%table) if row[1] != 'event_no']
+        cursor       = con.execute('SELECT event_no, %s FROM %s'%(', '.join(columns),table))
+        rows         = cursor.fetchmany(block_size)
+        while len(rows) > 0:
+            yield columns, np.array(rows, dtype = np.float64).reshape(-1, 1 + len(columns))
+            rows     = cursor.fetchmany(block_size)
+    finally:
+        con.close()
+
+def SourceColumns(hits,hits_idx,geo):
+    # The raw value of every features column the converter can write, one per pulse of hits (see FeatureColumns)
+    features          = converter.FeatureColumns(hits,geo)
+    columns           = {column: features[column].to_numpy() for column in converter.FEATURE_COLUMNS}
+    lengths           = np.asarray(hits_idx['stop'], dtype = np.int64) - np.asarray(hits_idx['start'], dtype = np.int64)
+    columns['dom_id'] = converter.DomIds(hits,geo)
+    columns['pulse_idx'] = np.arange(len(hits)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return columns
+
+def SourceTotals(pulses,truth,geo,chunks,event_offset = 0,selection = None):
+    # Expected content of the database, chunk by chunk of the memory-mapped arrays: the number of rows of every event
+    # in truth and in each features table, and per chunk the sum and the sum of absolute values of every column.
+    tables            = converter.FeatureTables(list(pulses.keys()))
+    counts            = {table: np.zeros(len(truth), dtype = np.int64) for table in ['truth'] + list(tables.values())}
+    sums              = {table: {} for table in counts.keys()}
+    for j in range(len(chunks)):
+        first, last   = chunks[j]
+        selected      = np.arange(last - first) if selection is None else converter.SelectEvents(truth[first:last],event_offset + first,selection)
+        truth_chunk   = converter.ExtractTruth(truth[first:last][selected],event_offset = event_offset + first,event_no = event_offset + first + 1 + selected)
+        counts['truth'][first + selected] = 1
+        AddSums(sums['truth'],j,len(chunks),{column: truth_chunk[column].to_numpy() for column in truth_chunk.columns})
+        for key in pulses.keys():
+            data, data_index = pulses[key]
+            hits, hits_idx, rows = converter.SelectPulses(data,data_index[first:last],selected)
+            counts[tables[key]][first + selected] = np.asarray(hits_idx['stop'], dtype = np.int64) - np.asarray(hits_idx['start'], dtype = np.int64)
+            AddSums(sums[tables[key]],j,len(chunks),SourceColumns(hits,hits_idx,geo))
+    return counts, sums
+
+def AddSums(sums,chunk,n_chunks,columns):
+    # sums[column] holds the sum and the sum of absolute values of column for every chunk
+    for column in columns.keys():
+        values = np.asarray(columns[column], dtype = np.float64)
+        if column not in sums:
+            sums[column] = np.zeros((n_chunks, 2))
+        sums[column][chunk] += [values.sum(), np.abs(values).sum()]
+    return
+
+def Validate(db,array_path,key,gcd_path,df_size = 1000000,tolerance = TOLERANCE,select = None,subsample = None,seed = 0,event_offset = None,block_size = 1000000,json_path = None):
+    #
+    # Checks a finished database against the arrays it was converted from, in two streaming passes:
+    # the source arrays are memory-mapped and walked in event-aligned chunks of roughly df_size pulses, and every table of
+    # the database (all shards of a catalog, or a --backend parquet directory) is scanned once in storage order,
+    # block_size rows at a time, with its rows binned into the same chunks by event_no. Reports
+    #   - events missing from truth, duplicated in it, or that should not be there (outside the source or not selected),
+    #   - events whose number of rows in a features table differs from stop - start in index.npy,
+    #   - chunks where the sum of a column differs from the source, after undoing the scaling with the transforms table.
+    # The database must have been written with the same --select, --subsample and --seed. Returns the report as a dict.
+    #
+    start_time            = time.time()
+    keys                  = [key] if isinstance(key, str) else list(key)
+    selection             = converter.ParseSelection(select,subsample,seed)
+    db_files              = DatabaseFiles(db)
+    pulses, truth         = converter.OpenArrays(array_path,keys,verbose = False)
+    geo                   = converter.GrabGCD(gcd_path)
+    offset, other_sources = SourceOffset(db_files,array_path)
+    event_offset          = offset if event_offset is None else event_offset
+    chunks                = converter.EventChunks(pulses[keys[0]][1],df_size)
+    starts                = np.array([chunk[0] for chunk in chunks], dtype = np.int64)
+    print('SUMMING %s EVENTS OF %s IN %s CHUNKS'%(len(truth),array_path,len(chunks)))
+    expected_counts, expected_sums = SourceTotals(pulses,truth,geo,chunks,event_offset,selection)
+
+    counts                = {table: np.zeros(len(truth), dtype = np.int64) for table in expected_counts.keys()}
+    sums                  = {table: {} for table in expected_counts.keys()}
+    outside               = []
+    n_rows                = 0
+    for db_file in db_files:
+        transforms        = ReadTableTransforms(db_file)
+        names             = TableNames(db_file)
+        for table in counts.keys():
+            stored        = converter.BlobTable(table) if converter.BlobTable(table) in names else table
+            if stored not in names:
+                continue
+            print('SCANNING %s IN %s'%(stored,db_file))
+            for columns, block in TableBlocks(db_file,stored,block_size):
+                n_rows   += len(block)
+                position  = block[:, 0].astype(np.int64) - event_offset - 1
+                inside    = (position >= 0) & (position < len(truth))
+                if not np.all(inside):
+                    outside += np.unique(block[~inside, 0].astype(np.int64)).tolist()[:MAX_REPORTED]
+                    position = position[inside]
+                    block    = block[inside]
+                counts[table] += np.bincount(position, minlength = len(truth))
+                values    = block[:, 1:]
+                if transforms is not None and transforms.applied:
+                    values = transforms.inverse(stored,columns,values)
+                chunk     = np.searchsorted(starts, position, side = 'right') - 1
+                for k in range(len(columns)):
+                    if columns[k] not in sums[table]:
+                        sums[table][columns[k]] = np.zeros(len(chunks))
+                    sums[table][columns[k]] += np.bincount(chunk, weights = values[:, k], minlength = len(chunks))
+        if transforms is None:
+            print('%s HAS NO TRANSFORMS TABLE, SO THE SUMS OF ITS SCALED COLUMNS WILL NOT MATCH'%db_file)
+
+    def EventNumbers(positions):
+        return (positions[:MAX_REPORTED] + event_offset + 1).tolist()
+
+    report                = {'database': db, 'array_path': os.path.abspath(array_path), 'event_offset': event_offset, 'rows_scanned': n_rows}
+    expected              = expected_counts['truth'] > 0
+    report['missing']     = EventNumbers(np.flatnonzero(expected & (counts['truth'] == 0)))
+    report['duplicated']  = EventNumbers(np.flatnonzero(counts['truth'] > 1))
+    report['unexpected']  = EventNumbers(np.flatnonzero(~expected & (counts['truth'] > 0)))
+    report['outside']     = [] if other_sources else sorted(set(outside))[:MAX_REPORTED]
+    report['missing_tables'] = [table for table in counts.keys() if not np.any(counts[table]) and np.any(expected_counts[table])]
+    report['count_mismatch'] = {}
+    report['sum_mismatch']   = {}
+    for table in counts.keys():
+        wrong             = np.flatnonzero(counts[table] != expected_counts[table])
+        if len(wrong) > 0:
+            report['count_mismatch'][table] = {'n_events': len(wrong), 'event_no': EventNumbers(wrong)}
+        for column in sums[table].keys():
+            if column not in expected_sums[table]:
+                continue
+            total, absolute = expected_sums[table][column][:, 0], expected_sums[table][column][:, 1]
+            wrong         = np.flatnonzero(np.abs(sums[table][column] - total) > tolerance*np.maximum(absolute,1.0))
+            for j in wrong[:MAX_REPORTED].tolist():
+                report['sum_mismatch'].setdefault(table, []).append({'column': column,
+                                                                     'first_event_no': chunks[j][0] + event_offset + 1,
+                                                                     'last_event_no': chunks[j][1] + event_offset,
+                                                                     'database': float(sums[table][column][j]),
+                                                                     'source': float(total[j])})
+    report['ok']          = not any([report[name] for name in ['missing', 'duplicated', 'unexpected', 'outside', 'missing_tables', 'count_mismatch', 'sum_mismatch']])
+    report['seconds']     = time.time() - start_time
+    for name in ['missing', 'duplicated', 'unexpected', 'outside', 'missing_tables']:
+        if len(report[name]) > 0:
+            print('%s: %s'%(name.upper(),report[name]))
+    for table in report['count_mismatch'].keys():
+        print('WRONG NUMBER OF ROWS IN %s FOR %s EVENTS, E.G. event_no %s'%(table,report['count_mismatch'][table]['n_events'],report['count_mismatch'][table]['event_no']))
+    for table in report['sum_mismatch'].keys():
+        for mismatch in report['sum_mismatch'][table]:
+            print('SUM OF %s.%s FOR event_no %s-%s IS %s, EXPECTED %s'%(table,mismatch['column'],mismatch['first_event_no'],mismatch['last_event_no'],mismatch['database'],mismatch['source']))
+    print('%s: %s ROWS CHECKED IN %.1f s (%.0f rows/sec)'%('VALID' if report['ok'] else 'INVALID',n_rows,report['seconds'],n_rows/max(report['seconds'],1e-9)))
+    if json_path is not None:
+        with open(json_path, 'w') as tmp:
+            json.dump(report, tmp, indent = 2)
+    return report
+
+def parse_args(description=__doc__):
+    """Parse command line args"""
+    parser = ArgumentParser(
+        description=description,
+        formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--db', type=str, required=True,
+        help='The database to check: a .db file, the _catalog.json of a sharded database or the .parquet directory of --backend parquet',
+    )
+    parser.add_argument(
+        '--array_path', type=str, required=True,
+        help='The i3cols directory the database was converted from',
+    )
+    parser.add_argument(
+        '--key', type=str, nargs='+', required=True,
+        help='Pulse series in the database, as given to create_databasev2.py',
+    )
+    parser.add_argument(
+        '--gcd_path', type=str, required=True,
+        help='As given to create_databasev2.py',
+    )
+    parser.add_argument(
+        '--df_size', type=int, default=1000000,
+        help='Approximate number of pulses per chunk of the source arrays. Sum mismatches are reported per chunk',
+    )
+    parser.add_argument(
+        '--block_size', type=int, default=1000000,
+        help='Rows read from the database at a time',
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=TOLERANCE,
+        help='Largest allowed relative difference of the column sums. Use about 1e-6 for --precision single',
+    )
+    parser.add_argument(
+        '--select', type=str, nargs='+', default=None,
+        help='As given to create_databasev2.py',
+    )
+    parser.add_argument(
+        '--subsample', type=float, default=None,
+        help='As given to create_databasev2.py',
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='As given to create_databasev2.py',
+    )
+    parser.add_argument(
+        '--event_offset', type=int, default=None,
+        help='event_no of the first event of array_path minus 1. Read from the manifest of the database by default, else 0',
+    )
+    parser.add_argument(
+        '--json_path', type=str, default=None,
+        help='Where to write the report as JSON',
+    )
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    if not Validate(**vars(parse_args()))['ok']:
+        raise SystemExit(1)
@@ -4,12 +4,21 @@
 
 """
 Extract positional and calibration info for DOMs
-and save the resulting dict in a pkl file for later use
+and save the resulting dict in a pkl file and/or a geometry cache for later use
 """
 
 from __future__ import absolute_import, division, print_function
 
-__all__ = ['N_STRINGS', 'N_DOMS', 'extract_gcd', 'parse_args']
+__all__ = [
+    'N_STRINGS',
+    'N_DOMS',
+    'CACHE_ARRAYS',
+    'CACHE_INFO',
+    'extract_gcd',
+    'load_cached_gcd',
+    'save_cached_gcd',
+    'parse_args',
+]
 
 __author__ = 'P. Eller, J.L. Lanfranchi'
 __license__ = '''Copyright 2017 Philipp Eller and Justin L. Lanfranchi
@@ -26,16 +35,19 @@ limitations under the License.'''
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import bz2
 from collections import OrderedDict
-import gzip
 import hashlib
+import json
 import os
 from os.path import (
-    abspath, expanduser, expandvars, dirname, isfile, join, split, splitext
+    abspath, expanduser, expandvars, dirname, isdir, isfile, join, split, splitext
 )
+import shutil
 import sys
+import tempfile
+import zlib
 
 import numpy as np
-from six import PY2, BytesIO
+from six import PY2
 from six.moves import cPickle as pickle
 import zstandard
 
@@ -50,16 +62,173 @@ from retro.utils.misc import mkdir
 N_STRINGS = 86
 N_DOMS = 60
 
+CACHE_ARRAYS = ('geo', 'noise', 'rde')
+"""Arrays stored as <name>.npy in each entry of the geometry cache"""
 
-def extract_gcd(gcd_file, outdir=None):
+CACHE_INFO = ('source_gcd_name', 'source_gcd_md5', 'source_gcd_i3_md5')
+"""Keys of gcd_info stored in the info.json of each entry of the geometry cache"""
+
+READ_SIZE = 1 << 20
+"""Bytes of the (compressed) GCD file read and decompressed at a time"""
+
+
+class StreamDecompressor(object):
+    """Incremental decompressor for one compression layer of a file. Also
+    handles several concatenated streams, as written by e.g. `pbzip2` or
+    `cat a.gz b.gz`.
+
+    Parameters
+    ----------
+    comp_alg : str
+        One of 'gz', 'bz2' or 'zst'
+
+    """
+    def __init__(self, comp_alg):
+        self.comp_alg = comp_alg
+        self.decompressor = self._new_decompressor()
+
+    def _new_decompressor(self):
+        if self.comp_alg == 'gz':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.comp_alg == 'bz2':
+            return bz2.BZ2Decompressor()
+        if self.comp_alg == 'zst':
+            return zstandard.ZstdDecompressor().decompressobj()
+        raise ValueError('Unhandled compression "{}"'.format(self.comp_alg))
+
+    def decompress(self, data):
+        """Decompress the next piece of the file; returns whatever output
+        that piece completes (possibly nothing)"""
+        output = []
+        while data:
+            if getattr(self.decompressor, 'eof', False):
+                self.decompressor = self._new_decompressor()
+            output.append(self.decompressor.decompress(data))
+            data = getattr(self.decompressor, 'unused_data', b'')
+        return b''.join(output)
+
+
+def hash_gcd_file(fpath, compression, keep_decompressed=False):
+    """Stream a possibly compressed file once, hashing it as stored and as
+    decompressed. Memory use is bounded by `READ_SIZE` and the decompressed
+    size of one chunk; there is no limit on the size of the file.
+
+    Parameters
+    ----------
+    fpath : str
+    compression : sequence of str
+        Compression layers, outermost first, as found from the extensions
+    keep_decompressed : bool
+        Also return the decompressed contents (only sensible for small
+        files, like pickles)
+
+    Returns
+    -------
+    md5 : str
+        md5sum of the file as stored
+    decompressed_md5 : str
+        md5sum of the file after decompressing all layers
+    decompressed : bytes or None
+
+    """
+    decompressors = [StreamDecompressor(comp_alg) for comp_alg in compression]
+    md5 = hashlib.md5()
+    decompressed_md5 = hashlib.md5()
+    kept = []
+    with open(fpath, 'rb') as fobj:
+        while True:
+            chunk = fobj.read(READ_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+            for decompressor in decompressors:
+                chunk = decompressor.decompress(chunk)
+            decompressed_md5.update(chunk)
+            if keep_decompressed:
+                kept.append(chunk)
+    decompressed = b''.join(kept) if keep_decompressed else None
+    return md5.hexdigest(), decompressed_md5.hexdigest(), decompressed
+
+
+def load_cached_gcd(cache_dir, i3_md5, mmap_mode='r'):
+    """Load GCD info from the content-addressed geometry cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+    i3_md5 : str
+        md5sum of the decompressed GCD .i3 file, i.e. 'source_gcd_i3_md5'
+    mmap_mode : str or None
+        Passed to `numpy.load`; by default the arrays are memory-mapped
+
+    Returns
+    -------
+    gcd_info : OrderedDict
+        Same keys as returned by `extract_gcd`
+
+    """
+    entry = join(expanduser(expandvars(cache_dir)), i3_md5)
+    with open(join(entry, 'info.json'), 'r') as fobj:
+        info = json.load(fobj)
+    gcd_info = OrderedDict()
+    for key in CACHE_INFO:
+        gcd_info[key] = info[key]
+    for name in CACHE_ARRAYS:
+        gcd_info[name] = np.load(join(entry, name + '.npy'), mmap_mode=mmap_mode)
+    return gcd_info
+
+
+def save_cached_gcd(cache_dir, gcd_info):
+    """Save GCD info to the geometry cache as `cache_dir/<i3 md5>/`, holding
+    geo.npy, noise.npy, rde.npy and info.json. The entry is written to a
+    temporary directory and renamed into place, so readers never see a
+    partial entry and concurrent writers of the same GCD do not collide.
+
+    Parameters
+    ----------
+    cache_dir : str
+    gcd_info : mapping
+        As returned by `extract_gcd`
+
+    Returns
+    -------
+    entry : str
+        Path of the cache entry
+
+    """
+    cache_dir = expanduser(expandvars(cache_dir))
+    mkdir(cache_dir)
+    entry = join(cache_dir, gcd_info['source_gcd_i3_md5'])
+    if isdir(entry):
+        return entry
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    for name in CACHE_ARRAYS:
+        np.save(join(tmp_dir, name + '.npy'), np.asarray(gcd_info[name]))
+    with open(join(tmp_dir, 'info.json'), 'w') as fobj:
+        json.dump(dict((key, gcd_info[key]) for key in CACHE_INFO), fobj, indent=1)
+    try:
+        os.rename(tmp_dir, entry)
+    except OSError:
+        # another process cached the same GCD first
+        shutil.rmtree(tmp_dir)
+    return entry
+
+
+def extract_gcd(gcd_file, outdir=None, cache_dir=None):
     """Extract info from a GCD in i3 format, optionally saving to a simple
-    Python pickle file.
+    Python pickle file and/or to a content-addressed geometry cache.
+    The GCD file is decompressed and hashed in chunks, so memory use does not
+    grow with its size.
     Parameters
     ----------
     gcd_file : str
     outdir : str, optional
         If provided, the gcd info is saved to a .pkl file with same name as
         `gcd_file` just with extension replaced.
+    cache_dir : str, optional
+        If provided, the gcd info is saved to `cache_dir/<source_gcd_i3_md5>/`
+        as .npy arrays (see `save_cached_gcd`), and a GCD whose i3 md5 is
+        already in the cache is loaded from there instead of being parsed.
     Returns
     -------
     gcd_info : OrderedDict
@@ -93,12 +262,17 @@ def extract_gcd(gcd_file, outdir=None):
         mkdir(outdir)
         pkl_outfpath = join(outdir, pkl_outfname)
         if isfile(pkl_outfpath):
-            return load_pickle(pkl_outfpath)
+            gcd_info = load_pickle(pkl_outfpath)
+            if cache_dir is not None:
+                save_cached_gcd(cache_dir, gcd_info)
+            return gcd_info
 
     def save_pickle_if_appropriate(gcd_info):
         if pkl_outfpath is not None:
             with open(pkl_outfpath, 'wb') as fobj:
                 pickle.dump(gcd_info, fobj, protocol=pickle.HIGHEST_PROTOCOL)
+        if cache_dir is not None:
+            save_cached_gcd(cache_dir, gcd_info)
 
     # Look for existing extracted (pkl) version in choice directories
     look_in_dirs = []
@@ -163,24 +337,12 @@ def extract_gcd(gcd_file, outdir=None):
                 " optionally followed by compression extension(s)".format(gcd_file)
             )
 
-    with open(src_fpath, 'rb') as fobj:
-        decompressed = fobj.read()
-
-    # Don't hash a pickle file; all we care about is the hash of the original
-    # i3 file, which is a value already stored in the pickle file
-    if ext_lower == 'i3':
-        source_gcd_md5 = hashlib.md5(decompressed).hexdigest()
-
-    for comp_alg in compression:
-        if comp_alg == 'gz':
-            decompressed = gzip.GzipFile(fileobj=BytesIO(decompressed)).read()
-        elif comp_alg == 'bz2':
-            decompressed = bz2.decompress(decompressed)
-        elif comp_alg == 'zst':
-            decompressor = zstandard.ZstdDecompressor()
-            decompressed = decompressor.decompress(
-                decompressed, max_output_size=100000000
-            )
+    # Stream through the file once, decompressing and hashing chunk by chunk.
+    # Only a pickle is kept in memory; all we care about for an i3 file is
+    # its hashes, as icecube reads the file itself below.
+    source_gcd_md5, decompressed_gcd_md5, decompressed = hash_gcd_file(
+        src_fpath, compression, keep_decompressed=ext_lower == 'pkl'
+    )
 
     if ext_lower == 'pkl':
         if PY2:
@@ -192,12 +354,17 @@ def extract_gcd(gcd_file, outdir=None):
 
     # -- If we get here, we have an i3 file -- #
 
-    decompressed_gcd_md5 = hashlib.md5(decompressed).hexdigest()
+    if cache_dir is not None and isdir(
+        join(expanduser(expandvars(cache_dir)), decompressed_gcd_md5)
+    ):
+        gcd_info = load_cached_gcd(cache_dir, decompressed_gcd_md5)
+        save_pickle_if_appropriate(gcd_info)
+        return gcd_info
 
     from I3Tray import I3Units, OMKey  # pylint: disable=import-error
     from icecube import dataclasses, dataio  # pylint: disable=import-error, unused-variable, unused-import
 
-    gcd = dataio.I3File(gcd_file) # pylint: disable=no-member
+    gcd = dataio.I3File(src_fpath) # pylint: disable=no-member
     frame = gcd.pop_frame()
 
     omgeo, dom_cal = None, None
@@ -257,11 +424,23 @@ def parse_args(description=__doc__):
         help='Input GCD file. See e.g. files in $I3_DATA/GCD directory.'
     )
     parser.add_argument(
-        '--outdir', type=str, required=True,
+        '--outdir', type=str, default=None,
         help='Directory into which to save the resulting .pkl file',
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', type=str, default=None,
+        help="""Geometry cache directory. The result is saved there as
+        <i3 md5>/geo.npy, noise.npy, rde.npy and info.json, which
+        NumpyToSQLite can load by passing the entry as --gcd_path""",
+    )
+    args = parser.parse_args()
+    if args.outdir is None and args.cache_dir is None:
+        parser.error('At least one of --outdir and --cache-dir is required')
+    return args
 
 
 if __name__ == '__main__':
-    extract_gcd(**vars(parse_args()))
+    ARGS = parse_args()
+    GCD_INFO = extract_gcd(**vars(ARGS))
+    if ARGS.cache_dir is not None:
+        print(join(expanduser(expandvars(ARGS.cache_dir)), GCD_INFO['source_gcd_i3_md5']))